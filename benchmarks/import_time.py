@@ -0,0 +1,87 @@
+"""
+Benchmark of release-tool start up time.
+
+Runs `python -m release -h` several times and checks that it stays fast
+and doesn't import heavy client libraries (they are needed only by commands).
+
+Usage, from repository root:
+    python benchmarks/import_time.py [--runs 10] [--max-ms 300]
+"""
+
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+
+HEAVY_MODULES = {"jira", "github", "yaml", "semver", "requests"}
+IMPORT_TIME_RE = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)$")
+COMMAND = [sys.executable, "-m", "release", "-h"]
+
+
+def get_imported_modules():
+    """{top level module: cumulative import time, us} of CLI start"""
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", *COMMAND[1:]],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stderr
+
+    modules = {}
+    for line in output.splitlines():
+        match = IMPORT_TIME_RE.match(line)
+        if match:
+            cumulative, _, name = match.groups()
+            top_level = name.split(".")[0]
+            modules[top_level] = max(modules.get(top_level, 0), int(cumulative))
+    return modules
+
+
+def measure(runs: int):
+    durations = []
+    for _ in range(runs):
+        started_at = time.perf_counter()
+        subprocess.run(COMMAND, stdout=subprocess.DEVNULL, check=True)
+        durations.append((time.perf_counter() - started_at) * 1000)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--max-ms", type=float, default=300, help="max allowed median start time"
+    )
+    args = parser.parse_args()
+
+    modules = get_imported_modules()
+    print("Slowest imports:")
+    for name, cumulative in sorted(modules.items(), key=lambda i: -i[1])[:10]:
+        print(f"{cumulative / 1000:8.1f} ms  {name}")
+
+    durations = measure(args.runs)
+    median = statistics.median(durations)
+    print(
+        f"\n`{' '.join(COMMAND[1:])}`: median {median:.1f} ms,"
+        f" min {min(durations):.1f} ms, max {max(durations):.1f} ms"
+    )
+
+    failed = False
+    heavy = HEAVY_MODULES & set(modules)
+    if heavy:
+        print(f"Heavy modules are imported on start: {', '.join(sorted(heavy))}")
+        failed = True
+
+    if median > args.max_ms:
+        print(f"Start is slower than {args.max_ms} ms")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
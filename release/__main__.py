@@ -1,10 +1,31 @@
+from .plugins.cassette import CASSETTE
 from .plugins.common import print_error
 from .plugins.conf import parse_and_combine_args
+from .plugins.http_stats import HTTP_STATS
+from .plugins.profiling import PROFILER
 from .release import run
 
 
+settings = None
 try:
-    run(settings=parse_and_combine_args())
+    settings = parse_and_combine_args()
+    if settings.profile:
+        PROFILER.enable()
+    if settings.http_stats:
+        HTTP_STATS.enabled = True
+    if settings.record:
+        CASSETTE.record(settings.record)
+    if settings.replay:
+        CASSETTE.replay(settings.replay, shell=settings.replay_shell)
+    run(settings=settings)
 except Exception as exc:
     print_error(str(exc), with_traceback=True)
     exit(1)
+finally:
+    if settings and settings.profile:
+        PROFILER.print_summary()
+        PROFILER.save(settings.profile)
+    if settings and settings.http_stats:
+        HTTP_STATS.save(settings.http_stats)
+    if settings and settings.record:
+        CASSETTE.save()
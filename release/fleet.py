@@ -0,0 +1,170 @@
+"""
+Fleet mode: run release commands in many repositories in parallel.
+
+Usage:
+    python -m release.fleet prepare --repo ../frontend --repo ../native/release_tool.yml
+
+Every repository is released by a worker process without user interaction.
+Workers run repositories one by one, reusing Jira and GitHub clients and
+Jira versions looked up for previous ones; PR cache is shared via its file.
+"""
+
+import argparse
+import io
+import json
+import os
+import re
+import time
+import traceback
+from contextlib import redirect_stdout
+from multiprocessing import Pool
+from typing import List, NamedTuple, Optional, Tuple
+
+from .plugins.common import print_error, print_title
+from .plugins.conf import Command
+
+
+DEFAULT_CONFIG_NAME = "release_tool.yml"
+DEFAULT_PROCESSES = 4
+COLOR_RE = re.compile(r"\x1b\[[0-9;]*m")
+
+
+class RepositoryReport(NamedTuple):
+    path: str
+    ok: bool
+    duration: float
+    error: Optional[str]
+    output: str
+
+
+def _parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m release.fleet")
+    parser.add_argument("commands", nargs="+", choices=list(Command.values()))
+    parser.add_argument(
+        "--repo",
+        dest="repos",
+        action="append",
+        required=True,
+        metavar="PATH",
+        help="repository directory or path to its config file, can be repeated",
+    )
+    parser.add_argument(
+        "--config-name",
+        default=DEFAULT_CONFIG_NAME,
+        help=f"config file in repository directory (default {DEFAULT_CONFIG_NAME})",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=DEFAULT_PROCESSES,
+        help=f"repositories released in parallel (default {DEFAULT_PROCESSES})",
+    )
+    parser.add_argument(
+        "--jira-version",
+        metavar="NAME",
+        help="existing unreleased Jira version to use in all repositories",
+    )
+    parser.add_argument(
+        "--full-scan", action="store_true", help="passed to every repository"
+    )
+    parser.add_argument("--report", metavar="PATH", help="save combined report as JSON")
+    return parser.parse_args(argv)
+
+
+def _get_release_argv(args) -> List[str]:
+    argv = [*args.commands, "--noinput"]
+    if args.jira_version:
+        argv += ["--jira-version", args.jira_version]
+    if args.full_scan:
+        argv.append("--full-scan")
+    return argv
+
+
+def _locate(path: str, config_name: str):
+    """(repository directory, config file) of `--repo` value"""
+    path = os.path.abspath(path)
+    if os.path.isfile(path):
+        return os.path.dirname(path), path
+    return path, os.path.join(path, config_name)
+
+
+def release_repository(path: str, config: str, argv: List[str]) -> RepositoryReport:
+    """Run commands in repository, executed by worker processes"""
+    # imported here to not load clients in parent process
+    from .plugins.conf import parse_and_combine_args
+    from .plugins.git import FETCH, GIT
+    from .release import run
+
+    started_at = time.perf_counter()
+    output = io.StringIO()
+    error = None
+    try:
+        os.chdir(path)
+        # git state of previous repository
+        GIT.close()
+        FETCH.reset()
+        with redirect_stdout(output):
+            run(settings=parse_and_combine_args([*argv, "--config", config]))
+    except SystemExit as exc:
+        # error is already printed, use its last line
+        lines = [line for line in output.getvalue().splitlines() if line.strip()]
+        error = COLOR_RE.sub("", lines[-1]) if lines else f"Exited with code {exc.code}"
+    except Exception as exc:
+        output.write(traceback.format_exc())
+        error = str(exc) or type(exc).__name__
+
+    return RepositoryReport(
+        path=path,
+        ok=error is None,
+        duration=time.perf_counter() - started_at,
+        error=error,
+        output=output.getvalue(),
+    )
+
+
+def _release_repository(indexed_task) -> Tuple[int, RepositoryReport]:
+    index, task = indexed_task
+    return index, release_repository(*task)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = _parse_args(argv)
+    release_argv = _get_release_argv(args)
+    tasks = [(*_locate(repo, args.config_name), release_argv) for repo in args.repos]
+
+    reports: List[Optional[RepositoryReport]] = [None] * len(tasks)
+    processes = max(1, min(args.processes, len(tasks)))
+    with Pool(processes) as pool:
+        # output of repositories is printed as they are finished
+        for index, report in pool.imap_unordered(_release_repository, enumerate(tasks)):
+            print_title(f"{report.path}: {'done' if report.ok else 'failed'}")
+            print(report.output)
+            reports[index] = report
+
+    print_title("Fleet report")
+    for report in reports:
+        status = "ok" if report.ok else "FAILED"
+        print(f"{status:<6} {report.duration:7.1f}s  {report.path}")
+        if report.error:
+            print(f"{'':<6} {report.error}")
+
+    if args.report:
+        with open(args.report, "w") as fo:
+            json.dump(
+                {
+                    "commands": args.commands,
+                    "repositories": [report._asdict() for report in reports],
+                },
+                fo,
+                indent=2,
+            )
+        print(f"Report is saved to {args.report}")
+
+    failed = [report for report in reports if not report.ok]
+    if failed:
+        print_error(f"Failed in {len(failed)} of {len(tasks)} repositories")
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
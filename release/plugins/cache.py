@@ -0,0 +1,277 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Iterable, NamedTuple, Optional, Set
+
+from .conf import CacheSettings
+
+
+__all__ = [
+    "CachedPull",
+    "JournalEntry",
+    "LinksCursor",
+    "PullRequestCache",
+    "ReleaseCursors",
+    "ReleaseJournal",
+    "open_database",
+]
+
+
+class CachedPull(NamedTuple):
+    title: str
+    merge_commit_sha: Optional[str]
+    merged: bool
+    etag: Optional[str]
+    fetched_at: float
+
+
+class JournalEntry(NamedTuple):
+    result: Any
+    completed_at: float
+
+
+class LinksCursor(NamedTuple):
+    # last scanned commit of release branch
+    sha: str
+    linked_keys: Set[str]
+
+
+def open_database(settings: CacheSettings) -> Optional[sqlite3.Connection]:
+    """Open (and create if needed) local cache database, None if cache is disabled"""
+    if not settings.path:
+        return None
+
+    path = os.path.expanduser(settings.path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # connection is shared between threads of a pool, access is serialized by callers
+    return sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+
+
+class PullRequestCache:
+    """
+    Metadata of pull requests keyed by repository and PR number.
+
+    Merged PRs are used as is until `revalidate_after` seconds pass,
+    after that they are revalidated with a conditional request (ETag).
+    Entries older than `max_age` and all above `max_entries` are evicted.
+    """
+
+    def __init__(self, settings: CacheSettings):
+        self._revalidate_after = float(settings.revalidate_after)
+        self._max_age = float(settings.max_age)
+        self._max_entries = int(settings.max_entries)
+        self._lock = threading.Lock()
+        self._db = open_database(settings)
+
+        if self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS pull_requests ("
+                " repository TEXT NOT NULL,"
+                " number INTEGER NOT NULL,"
+                " title TEXT NOT NULL,"
+                " merge_commit_sha TEXT,"
+                " merged INTEGER NOT NULL,"
+                " etag TEXT,"
+                " fetched_at REAL NOT NULL,"
+                " PRIMARY KEY (repository, number))"
+            )
+            self._evict()
+
+    def _evict(self):
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM pull_requests WHERE fetched_at < ?",
+                (time.time() - self._max_age,),
+            )
+            self._db.execute(
+                "DELETE FROM pull_requests WHERE rowid NOT IN"
+                " (SELECT rowid FROM pull_requests ORDER BY fetched_at DESC LIMIT ?)",
+                (self._max_entries,),
+            )
+
+    def get(self, repository: str, number: int) -> Optional[CachedPull]:
+        if not self._db:
+            return None
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT title, merge_commit_sha, merged, etag, fetched_at"
+                " FROM pull_requests WHERE repository = ? AND number = ?",
+                (repository, number),
+            ).fetchone()
+
+        if not row:
+            return None
+
+        title, merge_commit_sha, merged, etag, fetched_at = row
+        return CachedPull(title, merge_commit_sha, bool(merged), etag, fetched_at)
+
+    def is_fresh(self, entry: CachedPull) -> bool:
+        # not merged PRs can still be renamed, always revalidate them
+        return entry.merged and time.time() - entry.fetched_at < self._revalidate_after
+
+    def put(
+        self,
+        repository: str,
+        number: int,
+        title: str,
+        merge_commit_sha: Optional[str],
+        merged: bool,
+        etag: Optional[str] = None,
+    ):
+        if not self._db:
+            return
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pull_requests"
+                " (repository, number, title, merge_commit_sha, merged, etag, fetched_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    repository,
+                    number,
+                    title,
+                    merge_commit_sha,
+                    int(merged),
+                    etag,
+                    time.time(),
+                ),
+            )
+
+    def touch(self, repository: str, number: int):
+        """Mark entry as just validated"""
+        if not self._db:
+            return
+
+        with self._lock:
+            self._db.execute(
+                "UPDATE pull_requests SET fetched_at = ?"
+                " WHERE repository = ? AND number = ?",
+                (time.time(), repository, number),
+            )
+
+
+class ReleaseCursors:
+    """Progress of `make-links` per release task, to scan only new commits on rerun"""
+
+    def __init__(self, settings: CacheSettings):
+        self._db = open_database(settings)
+
+        if self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS links_cursors ("
+                " release_task TEXT PRIMARY KEY,"
+                " sha TEXT NOT NULL,"
+                " linked_keys TEXT NOT NULL)"
+            )
+
+    def get(self, release_task_key: str) -> Optional[LinksCursor]:
+        if not self._db:
+            return None
+
+        row = self._db.execute(
+            "SELECT sha, linked_keys FROM links_cursors WHERE release_task = ?",
+            (release_task_key,),
+        ).fetchone()
+
+        if not row:
+            return None
+
+        sha, linked_keys = row
+        return LinksCursor(sha=sha, linked_keys=set(linked_keys.split()))
+
+    def save(self, release_task_key: str, sha: str, linked_keys: Iterable[str]):
+        if not self._db:
+            return
+
+        self._db.execute(
+            "INSERT OR REPLACE INTO links_cursors (release_task, sha, linked_keys)"
+            " VALUES (?, ?, ?)",
+            (release_task_key, sha, " ".join(sorted(linked_keys))),
+        )
+
+
+class ReleaseJournal:
+    """
+    Steps of a release completed by previous runs with their (JSON) results,
+    so a failed run can be resumed. Release is resolved on first use, as its
+    name is known only after project version is.
+    """
+
+    def __init__(
+        self, settings: CacheSettings, get_release: Callable[[], str], restart=False
+    ):
+        self._db = open_database(settings)
+        self._max_age = int(settings.max_age)
+        self._get_release = get_release
+        self._release: Optional[str] = None
+        self._restart = restart
+        self._lock = threading.Lock()
+
+        if self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS release_journal ("
+                " release TEXT NOT NULL,"
+                " step TEXT NOT NULL,"
+                " result TEXT NOT NULL,"
+                " completed_at REAL NOT NULL,"
+                " PRIMARY KEY (release, step))"
+            )
+
+    @property
+    def release(self) -> str:
+        with self._lock:
+            if self._release is None:
+                self._release = self._get_release()
+                if self._db:
+                    self._db.execute(
+                        "DELETE FROM release_journal WHERE completed_at < ?",
+                        (time.time() - self._max_age,),
+                    )
+                    if self._restart:
+                        self._db.execute(
+                            "DELETE FROM release_journal WHERE release = ?",
+                            (self._release,),
+                        )
+            return self._release
+
+    def get(self, step: str) -> Optional[JournalEntry]:
+        if not self._db:
+            return None
+
+        release = self.release
+        with self._lock:
+            row = self._db.execute(
+                "SELECT result, completed_at FROM release_journal"
+                " WHERE release = ? AND step = ?",
+                (release, step),
+            ).fetchone()
+
+        if not row:
+            return None
+        return JournalEntry(result=json.loads(row[0]), completed_at=row[1])
+
+    def save(self, step: str, result: Any):
+        if not self._db:
+            return
+
+        release = self.release
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO release_journal"
+                " (release, step, result, completed_at) VALUES (?, ?, ?, ?)",
+                (release, step, json.dumps(result), time.time()),
+            )
+
+    def discard(self, step: str):
+        if not self._db:
+            return
+
+        release = self.release
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM release_journal WHERE release = ? AND step = ?",
+                (release, step),
+            )
@@ -0,0 +1,179 @@
+import base64
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import defaultdict, deque
+from datetime import date
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+
+__all__ = ["CASSETTE", "Cassette", "CassetteMiss"]
+
+HTTP_FILE = "http.jsonl.gz"
+SHELL_FILE = "shell.jsonl.gz"
+# values of a run sent to services, e.g. release date, which replay must repeat
+RUN_FILE = "run.json"
+# not valid for replayed content, which is stored decoded
+SKIPPED_HEADERS = frozenset({"content-encoding", "content-length", "transfer-encoding"})
+# session cookies and credentials, cassettes may be shared
+SECRET_HEADERS = frozenset(
+    {
+        "set-cookie",
+        "authorization",
+        "proxy-authorization",
+        "atlassian.xsrf.token",
+        "x-ausername",
+    }
+)
+
+
+class CassetteMiss(LookupError):
+    pass
+
+
+class Cassette:
+    """
+    Records Jira and GitHub HTTP exchanges and outputs of shell commands of a run
+    (`--record DIR`) and serves them back instead of services (`--replay DIR`),
+    shell commands are replayed only if asked to (`--replay-shell`).
+    Identical requests are replayed in order they were recorded.
+    Does nothing until started.
+    """
+
+    def __init__(self):
+        self.recording = False
+        self.replaying = False
+        self.replaying_shell = False
+        self._path: Optional[str] = None
+        self._lock = threading.Lock()
+        self._http: Dict[Tuple, Deque[dict]] = defaultdict(deque)
+        self._shell: Dict[str, Deque[str]] = defaultdict(deque)
+        self._recorded_http = []
+        self._recorded_shell = []
+        self._date: Optional[date] = None
+
+    def record(self, path: str):
+        self.recording = True
+        self._path = path
+        self._date = date.today()
+
+    def replay(self, path: str, shell: bool = False):
+        self.replaying = True
+        self.replaying_shell = shell
+        self._path = path
+        run_path = os.path.join(path, RUN_FILE)
+        if os.path.exists(run_path):
+            with open(run_path) as fo:
+                self._date = date.fromisoformat(json.load(fo)["date"])
+        for entry in _read(os.path.join(path, HTTP_FILE)):
+            self._http[_get_key(entry)].append(entry)
+        if shell:
+            for entry in _read(os.path.join(path, SHELL_FILE)):
+                self._shell[entry["command"]].append(entry["output"])
+
+    def record_response(self, service: str, request, response):
+        if not self.recording:
+            return
+
+        entry = {
+            "service": service,
+            "method": request.method,
+            "url": request.url,
+            "body": _get_body_hash(request.body),
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": {
+                name: value
+                for name, value in response.headers.items()
+                if name.lower() not in SKIPPED_HEADERS | SECRET_HEADERS
+            },
+            "content": base64.b64encode(response.content).decode("ascii"),
+        }
+        with self._lock:
+            self._recorded_http.append(entry)
+
+    def replay_response(self, service: str, request):
+        # not imported at module level to not load requests for shell only runs
+        from requests import Response
+        from requests.structures import CaseInsensitiveDict
+        from requests.utils import get_encoding_from_headers
+
+        key = (service, request.method, request.url, _get_body_hash(request.body))
+        with self._lock:
+            if not self._http.get(key):
+                raise CassetteMiss(
+                    f"No recorded response to {request.method} {request.url}"
+                )
+            entry = self._http[key].popleft()
+
+        response = Response()
+        response.status_code = entry["status"]
+        response.reason = entry["reason"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = base64.b64decode(entry["content"])
+        response.url = request.url
+        response.request = request
+        return response
+
+    def today(self) -> date:
+        """Date of the run, recorded one when replaying"""
+        return self._date or date.today()
+
+    def shell(self, command: str, execute: Callable[[], bytes]) -> bytes:
+        """Output of shell command: recorded one when replaying, executed otherwise"""
+        if self.replaying_shell:
+            with self._lock:
+                if not self._shell.get(command):
+                    raise CassetteMiss(f"No recorded output of `{command}`")
+                return self._shell[command].popleft().encode("utf-8")
+
+        output = execute()
+        if self.recording:
+            with self._lock:
+                self._recorded_shell.append(
+                    {"command": command, "output": output.decode("utf-8")}
+                )
+        return output
+
+    def save(self):
+        os.makedirs(self._path, exist_ok=True)
+        _write(os.path.join(self._path, HTTP_FILE), self._recorded_http)
+        _write(os.path.join(self._path, SHELL_FILE), self._recorded_shell)
+        with open(os.path.join(self._path, RUN_FILE), "w") as fo:
+            json.dump({"date": self._date.isoformat()}, fo)
+        print(
+            f"Recorded {len(self._recorded_http)} HTTP exchanges"
+            f" and {len(self._recorded_shell)} shell commands to {self._path}"
+        )
+
+
+def _get_key(entry: dict) -> Tuple:
+    return entry["service"], entry["method"], entry["url"], entry["body"]
+
+
+def _get_body_hash(body) -> Optional[str]:
+    if body is None:
+        return None
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return hashlib.sha1(body).hexdigest()
+
+
+def _read(path: str):
+    if not os.path.exists(path):
+        return
+    with gzip.open(path, "rt", encoding="utf-8") as fo:
+        for line in fo:
+            yield json.loads(line)
+
+
+def _write(path: str, entries):
+    with gzip.open(path, "wt", encoding="utf-8") as fo:
+        for entry in entries:
+            fo.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+
+CASSETTE = Cassette()
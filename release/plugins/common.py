@@ -6,6 +6,9 @@ from typing import Callable, Optional
 
 from termcolor import colored
 
+from .cassette import CASSETTE
+from .profiling import PROFILER
+
 
 symbol = "#"
 
@@ -21,24 +24,29 @@ class BashFunc:
 
         print(f"> {self}")
         try:
-            output = subprocess.check_output(
-                str(self), shell=True, stderr=subprocess.STDOUT
-            )
+            with PROFILER.span(str(self), "shell"):
+                output = CASSETTE.shell(str(self), self._execute)
         except Exception as exc:
             output = getattr(exc, "output", b"").decode("utf-8")
             print_error(f"ERROR: {exc}, Output:\n{output}", with_traceback=True)
             exit(1)
         return output.decode("utf-8")
 
-    def __str__(self):
+    def _execute(self) -> bytes:
+        return subprocess.check_output(str(self), shell=True, stderr=subprocess.STDOUT)
+
+    def _format(self, template: str) -> str:
         try:
-            return self.func.format(**self.kwargs)
+            return template.format(**self.kwargs)
         except Exception as exc:
             print_error(
                 f"Error: {exc}. In formatting bash function: `{self.func}` with parameters: `{self.kwargs}`"
             )
             exit(1)
 
+    def __str__(self):
+        return self._format(self.func)
+
 
 class Hooks:
     get_version: Callable[..., BashFunc]
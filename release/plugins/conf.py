@@ -1,14 +1,16 @@
 import argparse
 from dataclasses import MISSING, dataclass, fields
 from enum import Enum
-
-import yaml
-from semver import VersionInfo, bump_minor, bump_patch
+from typing import TYPE_CHECKING, List, Optional
 
 from .common import Hooks
 from .env import ENV_VARIABLE_NAMES, get_parameter
 
 
+if TYPE_CHECKING:
+    from semver import VersionInfo
+
+
 class ParameterMixin:
     SUBCLASSES = []
 
@@ -63,6 +65,8 @@ class Command(str, Enum):
     MERGE_TO_MASTER = "merge-to-master"
     MERGE_MASTER_TO_DEVELOP = "merge-master-to-develop"
 
+    RELEASE_NOTES = "release-notes"
+
     def __str__(self):
         return str(self.value)
 
@@ -71,6 +75,14 @@ class Command(str, Enum):
         return {e.value for e in cls.__members__.values()}
 
 
+class NotesFormat(str, Enum):
+    MARKDOWN = "markdown"
+    JSON = "json"
+
+    def __str__(self):
+        return str(self.value)
+
+
 @dataclass
 class JiraConnection(ParameterMixin):
     server: str
@@ -111,6 +123,10 @@ class JiraSettings:
 class GitHubSettings(ParameterMixin):
     token: str
     task_re: str
+    # number of pull requests resolved by a single GraphQL query, 0 to disable
+    pr_batch_size: int = 100
+    # `owner/name`, taken from origin remote of local repository if empty
+    repository: str = ""
 
 
 @dataclass
@@ -118,34 +134,102 @@ class GitSettings(ParameterMixin):
     base: str = "develop"
     master: str = "master"
     release_name: str = "release-{version}"
+    # git notes ref to share tasks resolved for commits, empty to disable
+    notes_ref: str = ""
+    # partial clone filter of fetch, e.g. `blob:none`, empty to fetch all objects
+    fetch_filter: str = ""
+
+
+@dataclass
+class CacheSettings(ParameterMixin):
+    # empty path disables the cache
+    path: str = "~/.cache/release-tool/cache.sqlite"
+    # seconds, after which merged PR is revalidated with a conditional request
+    revalidate_after: int = 24 * 60 * 60
+    # seconds, after which entry is evicted
+    max_age: int = 90 * 24 * 60 * 60
+    max_entries: int = 10000
+
+
+@dataclass
+class HttpSettings(ParameterMixin):
+    # requests per second and burst size, per service (Jira, GitHub)
+    rate: float = 10
+    burst: int = 10
+    # parallel requests per service, reduced while service throttles
+    concurrency: int = 5
+    max_retries: int = 5
+    # seconds, max delay between retries
+    max_backoff: float = 60
+    # seconds, max total wait asked for by service (Retry-After, rate limit reset)
+    max_wait: float = 3600
+    # seconds, timeout of connecting and of waiting for response data
+    timeout: float = 30
+    # per host timeouts overriding it: `host=seconds, ...`
+    timeouts: str = ""
 
 
 class Settings:
-    version: VersionInfo
+    version: "VersionInfo"
 
     def __init__(self, config, args=None):
         if args:
             self._commands = set(args.commands)
             self.prs = args.pr
             self.no_input = args.noinput
+            self.jira_version_name = args.jira_version
+            self.full_scan = args.full_scan
+            self.remote = args.remote
+            self.notes_format = args.notes_format
+            self.restart = args.restart
+            self.profile = args.profile and args.profile_output
+            self.http_stats = args.http_stats
+            self.record = args.record
+            self.replay = args.replay
+            self.replay_shell = args.replay_shell
             assert (
                 self.require_creation_of_hotfix_branch or not self.prs
             ), "'--pr' should be specified only for hotfix"
+            assert not (
+                self.remote and self.require_clean_repo
+            ), "'--remote' can't be used with commands changing git repository"
         else:
             # for debug purpose, to create settings without command line call
             self._commands = set()
             self.prs = ()
             self.no_input = False
+            self.jira_version_name = None
+            self.full_scan = False
+            self.remote = False
+            self.notes_format = NotesFormat.MARKDOWN
+            self.restart = False
+            self.profile = None
+            self.http_stats = None
+            self.record = None
+            self.replay = None
+            self.replay_shell = False
 
         self.jira = JiraSettings(**config.get("jira", {}))
         self.git = GitSettings.from_config(config.get("git", {}))
         self.hooks = Hooks(**config.get("hooks", {}))
         self.github = GitHubSettings.from_config(config.get("github", {}))
+        assert not (
+            self.remote and not self.github.repository
+        ), "'--remote' requires `github.repository` in config"
+        self.cache = CacheSettings.from_config(config.get("cache", {}))
+        self.http = HttpSettings.from_config(config.get("http", {}))
+        if self.record or self.replay:
+            # requests made don't depend on state of local cache and notes,
+            # and notes (read and pushed outside of cassette) are not changed
+            self.cache.path = ""
+            self.git.notes_ref = ""
 
     def parse_project_version(self):
         self.version = self._get_version()
 
-    def _get_version(self) -> VersionInfo:
+    def _get_version(self) -> "VersionInfo":
+        from semver import VersionInfo, bump_minor, bump_patch
+
         hook_result = self.hooks.get_version()()
         proposed_version = VersionInfo.parse(hook_result.strip())
 
@@ -187,6 +271,7 @@ class Settings:
                 Command.HOTFIX,
                 Command.MAKE_HOTFIX_BRANCH,
                 Command.MAKE_LINKS,
+                Command.RELEASE_NOTES,
             }
         )
 
@@ -236,6 +321,30 @@ class Settings:
             self._commands & {Command.MAKE_LINKS}
         )
 
+    @property
+    def require_release_notes(self) -> bool:
+        return bool(self._commands & {Command.RELEASE_NOTES})
+
+    @property
+    def require_github(self) -> bool:
+        return (
+            self.require_jira_links
+            or self.require_creation_of_hotfix_branch
+            or self.require_release_notes
+        )
+
+    @property
+    def require_jira(self) -> bool:
+        return (
+            self.require_jira_version
+            or self.require_creation_of_jira_task
+            or self.require_jira_task_search
+            or self.require_jira_links
+            or self.require_mark_release_task_done
+            or self.require_mark_chldren_tasks_done
+            or self.require_release_notes
+        )
+
     @property
     def require_mark_chldren_tasks_done(self) -> bool:
         return bool(self._commands & {Command.FINISH, Command.MARK_CHILDREN_TASKS_DONE})
@@ -267,7 +376,7 @@ class Settings:
         return bool(self._commands & {Command.HOTFIX, Command.MAKE_HOTFIX_BRANCH})
 
 
-def _parse_args():
+def _parse_args(argv: Optional[List[str]] = None):
     parser = argparse.ArgumentParser()
     parser.add_argument("commands", nargs="+", choices=list(Command.values()))
     parser.add_argument(
@@ -281,6 +390,79 @@ def _parse_args():
         "--noinput", help="run without user interaction", action="store_true"
     )
 
+    parser.add_argument(
+        "--jira-version",
+        metavar="NAME",
+        help="use existing unreleased Jira version instead of asking for one",
+    )
+
+    parser.add_argument(
+        "--full-scan",
+        help="link tasks of all commits in release branch,"
+        " not only of ones added after previous make-links run",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--notes-format",
+        default=NotesFormat.MARKDOWN.value,
+        choices=[notes_format.value for notes_format in NotesFormat],
+        help="format of release-notes written to stdout: Markdown or JSON Lines"
+        " (default markdown)",
+    )
+
+    parser.add_argument(
+        "--restart",
+        help="run all steps of release again, not only ones a previous run"
+        " didn't complete",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--remote",
+        help="read commits of release branch via GitHub API,"
+        " so make-links and release-notes don't need a local clone",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--profile",
+        help="save timings of run phases, commands and requests as Chrome trace"
+        " and print the slowest of them",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--profile-output",
+        default="release-profile.json",
+        help="Path to save profile to (default release-profile.json)",
+    )
+
+    parser.add_argument(
+        "--http-stats",
+        metavar="PATH",
+        help="save statistics of Jira and GitHub requests per endpoint:"
+        " Prometheus textfile if PATH ends with .prom, JSON otherwise",
+    )
+
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument(
+        "--record",
+        metavar="DIR",
+        help="save Jira and GitHub responses and outputs of shell commands to DIR",
+    )
+    cassette.add_argument(
+        "--replay",
+        metavar="DIR",
+        help="serve Jira and GitHub responses recorded to DIR instead of services",
+    )
+    parser.add_argument(
+        "--replay-shell",
+        action="store_true",
+        help="with --replay, use recorded outputs of shell commands instead of"
+        " running them, e.g. for a dry run",
+    )
+
     parser.add_argument(
         "--pr",
         action="append",
@@ -289,12 +471,16 @@ def _parse_args():
         help="Github pull request for hotfix release",
     )
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 def _load_config_file(config_path: str):
+    # imported here to not slow down `-h` and argument errors
+    import yaml
+
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
     with open(config_path) as fo:
-        return yaml.safe_load(fo.read())
+        return yaml.load(fo.read(), Loader=loader)
 
 
 def _to_snake_case(value):
@@ -306,8 +492,8 @@ def _to_snake_case(value):
     }
 
 
-def parse_and_combine_args() -> Settings:
-    args = _parse_args()
+def parse_and_combine_args(argv: Optional[List[str]] = None) -> Settings:
+    args = _parse_args(argv)
 
     config = _load_config_file(args.config)
     config = _to_snake_case(config)
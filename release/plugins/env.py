@@ -28,11 +28,31 @@ ENV_VARIABLE_NAMES = {
     "GitHubSettings": {
         "token": "RELEASE_TOOL_GITHUB_TOKEN",
         "task_re": "RELEASE_TOOL_GITHUB_TASK_RE",
+        "pr_batch_size": "RELEASE_TOOL_GITHUB_PR_BATCH_SIZE",
+        "repository": "RELEASE_TOOL_GITHUB_REPOSITORY",
     },
     "GitSettings": {
         "base": "RELEASE_TOOL_GIT_BASE",
         "master": "RELEASE_TOOL_GIT_MASTER",
         "release_name": "RELEASE_TOOL_GIT_RELEASE_NAME",
+        "notes_ref": "RELEASE_TOOL_GIT_NOTES_REF",
+        "fetch_filter": "RELEASE_TOOL_GIT_FETCH_FILTER",
+    },
+    "CacheSettings": {
+        "path": "RELEASE_TOOL_CACHE_PATH",
+        "revalidate_after": "RELEASE_TOOL_CACHE_REVALIDATE_AFTER",
+        "max_age": "RELEASE_TOOL_CACHE_MAX_AGE",
+        "max_entries": "RELEASE_TOOL_CACHE_MAX_ENTRIES",
+    },
+    "HttpSettings": {
+        "rate": "RELEASE_TOOL_HTTP_RATE",
+        "burst": "RELEASE_TOOL_HTTP_BURST",
+        "concurrency": "RELEASE_TOOL_HTTP_CONCURRENCY",
+        "max_retries": "RELEASE_TOOL_HTTP_MAX_RETRIES",
+        "max_backoff": "RELEASE_TOOL_HTTP_MAX_BACKOFF",
+        "max_wait": "RELEASE_TOOL_HTTP_MAX_WAIT",
+        "timeout": "RELEASE_TOOL_HTTP_TIMEOUT",
+        "timeouts": "RELEASE_TOOL_HTTP_TIMEOUTS",
     },
 }
 
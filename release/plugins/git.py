@@ -1,44 +1,101 @@
+import atexit
+import shlex
+import subprocess
+import threading
 from functools import partial
-from typing import Callable, Iterable
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set
 
 from .common import BashFunc, print_error, print_title
-from .conf import Settings
+from .conf import GitSettings, Settings
 
 
-__all__ = ["GitFuncs", "GitFlows", "check_repo_changes"]
+__all__ = [
+    "FETCH",
+    "GIT",
+    "FetchCoordinator",
+    "GitBackend",
+    "GitCommand",
+    "GitFuncs",
+    "GitFlows",
+    "TaskNotes",
+    "Commit",
+    "CommitNote",
+    "check_repo_changes",
+    "iter_commits",
+]
+
+LOG_CHUNK_SIZE = 64 * 1024
+
+
+class GitCommand(BashFunc):
+    """
+    Git command run without shell: parameters are substituted into arguments
+    of the template, so branch and version names are never interpreted
+    """
+
+    @property
+    def args(self) -> List[str]:
+        args = []
+        for arg in shlex.split(self.func):
+            # a list parameter as a whole argument is expanded to many arguments
+            value = self.kwargs.get(arg[1:-1]) if arg[:1] + arg[-1:] == "{}" else None
+            if isinstance(value, (list, tuple)):
+                args.extend(map(str, value))
+            else:
+                args.append(self._format(arg))
+        return args
+
+    def _execute(self) -> bytes:
+        return subprocess.check_output(self.args, stderr=subprocess.STDOUT)
+
+    def __str__(self):
+        return " ".join(map(shlex.quote, self.args))
 
 
 class GitFuncs:
-    check_repo_for_changes = partial(BashFunc, "git status --porcelain")
+    check_repo_for_changes = partial(GitCommand, "git status --porcelain")
 
-    fetch = partial(BashFunc, "git fetch")
+    fetch = partial(GitCommand, "git fetch")
+    fetch_branches = partial(
+        GitCommand, "git fetch -q --no-tags {options} origin {refspecs}"
+    )
+    ls_remote = partial(GitCommand, "git ls-remote -q origin {refs}")
     create_release_branch = partial(
-        BashFunc, "git checkout -q -b {branch} --no-track origin/{source}"
+        GitCommand, "git checkout -q -b {branch} --no-track origin/{source}"
     )
-    delete_remote_branch = partial(BashFunc, "git push -q origin :{branch}")
+    delete_remote_branch = partial(GitCommand, "git push -q origin :{branch}")
 
     # get actual updates to not accidentally commit newer version
-    submodule_update = partial(BashFunc, "git submodule update")
+    submodule_update = partial(GitCommand, "git submodule update")
 
-    cherry_pick = partial(BashFunc, "git cherry-pick {sha}")
-    commit = partial(BashFunc, 'git commit --allow-empty -am "Release {version}"')
-    push = partial(BashFunc, "git push -q -u origin {branch}")
-    checkout = partial(BashFunc, "git checkout -q {branch}")
-    hard_reset = partial(BashFunc, "git reset -q --hard {branch}")
+    # commits are picked in order with a single call
+    cherry_pick = partial(GitCommand, "git cherry-pick {shas}")
+    commit = partial(GitCommand, 'git commit --allow-empty -am "Release {version}"')
+    push = partial(GitCommand, "git push -q -u origin {branch}")
+    checkout = partial(GitCommand, "git checkout -q {branch}")
+    hard_reset = partial(GitCommand, "git reset -q --hard {branch}")
 
-    create_tag = partial(BashFunc, "git tag {version}")
-    push_tag = partial(BashFunc, "git push -q origin {version}")
+    create_tag = partial(GitCommand, "git tag {version}")
+    push_tag = partial(GitCommand, "git push -q origin {version}")
     merge = partial(
-        BashFunc, 'git merge -q --commit --no-ff {branch} -m "Merge, {branch}"'
+        GitCommand, 'git merge -q --commit --no-ff {branch} -m "Merge, {branch}"'
     )
 
 
 class GitFlows:
     def __init__(self, settings: Settings):
+        self._settings = settings
         self.version = settings.version
         self.release_branch = settings.git.release_name.format(version=self.version)
+        self.base_branch = settings.git.base
+        self.master_branch = settings.git.master
 
     def _create_tag(self) -> Iterable[BashFunc]:
+        tag = GIT.resolve(f"refs/tags/{self.version}")
+        if tag and tag == GIT.resolve(f"origin/{self.release_branch}"):
+            # created by a previous run, which failed to push it
+            return [GitFuncs.push_tag(version=self.version)]
+
         return [
             GitFuncs.checkout(branch=f"origin/{self.release_branch}"),
             GitFuncs.create_tag(version=self.version),
@@ -55,12 +112,11 @@ class GitFlows:
         ]
 
     def make_release_branch(self, release_set: Callable[..., BashFunc]):
-
+        FETCH.fetch(self._settings)
         execute_commands(
             "Make release branch",
-            GitFuncs.fetch(),
             GitFuncs.create_release_branch(
-                source="develop", branch=self.release_branch
+                source=self.base_branch, branch=self.release_branch
             ),
             GitFuncs.submodule_update(),
             release_set(version=self.version),
@@ -73,35 +129,348 @@ class GitFlows:
     def make_hotfix_branch(
         self, list_of_commit_sha, release_set: Callable[..., BashFunc]
     ):
+        list_of_commit_sha = list(list_of_commit_sha)
+        FETCH.fetch(self._settings)
         execute_commands(
             "Make hotfix branch",
-            GitFuncs.fetch(),
-            GitFuncs.create_release_branch(source="master", branch=self.release_branch),
-            *[
-                GitFuncs.cherry_pick(sha=commit_sha)
-                for commit_sha in list_of_commit_sha
-            ],
+            GitFuncs.create_release_branch(
+                source=self.master_branch, branch=self.release_branch
+            ),
+            *(
+                [GitFuncs.cherry_pick(shas=list_of_commit_sha)]
+                if list_of_commit_sha
+                else []
+            ),
             GitFuncs.submodule_update(),
             release_set(version=self.version),
             GitFuncs.commit(version=self.version),
             GitFuncs.push(branch=self.release_branch),
         )
 
-    def merge_release_to_master(self):
-        execute_commands("Create tag", GitFuncs.fetch(), *self._create_tag())
+    def create_tag(self):
+        FETCH.fetch(self._settings)
+        execute_commands("Create tag", *self._create_tag())
+
+    def merge_release_to_master(self, with_tag=True):
+        if with_tag:
+            self.create_tag()
+        FETCH.fetch(self._settings)
         execute_commands(
             "Merge release to master",
-            *self._merge(source=self.release_branch, target="master"),
+            *self._merge(source=self.release_branch, target=self.master_branch),
             GitFuncs.delete_remote_branch(branch=self.release_branch),
         )
 
-    @classmethod
-    def merge_master_to_develop(cls):
+    def merge_master_to_develop(self):
+        FETCH.fetch(self._settings)
         execute_commands(
             "Merge master to develop",
-            GitFuncs.fetch(),
-            *cls._merge(source="master", target="develop"),
+            *self._merge(source=self.master_branch, target=self.base_branch),
+        )
+
+
+class GitBackend:
+    """
+    Read-only access to repository without spawning git for every query:
+    objects are resolved by a single long-lived `git cat-file --batch-check`
+    process, refs and config are read with one call each.
+    Mutations are left to porcelain `GitCommand`s.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cat_file: Optional[subprocess.Popen] = None
+        self._config: Optional[Dict[str, str]] = None
+
+    def _batch_check(self, name: str) -> Optional[str]:
+        """Object name of `name`, None if it doesn't exist or is ambiguous"""
+        if not name or "\n" in name:
+            return None
+
+        with self._lock:
+            for _ in range(2):
+                if self._cat_file is None or self._cat_file.poll() is not None:
+                    self._cat_file = subprocess.Popen(
+                        ["git", "cat-file", "--batch-check=%(objectname)"],
+                        stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE,
+                        universal_newlines=True,
+                    )
+                try:
+                    self._cat_file.stdin.write(f"{name}\n")
+                    self._cat_file.stdin.flush()
+                    line = self._cat_file.stdout.readline()
+                except BrokenPipeError:
+                    line = ""
+                if line:
+                    break
+                # process died, e.g. it was started outside of repository
+                self._close()
+            else:
+                raise RuntimeError(f"git cat-file failed to resolve {name}")
+
+        if line.rstrip("\n").endswith((" missing", " ambiguous")):
+            return None
+        return line.strip()
+
+    def resolve(self, ref: str) -> Optional[str]:
+        """SHA of commit `ref` points to, None if there is no such commit"""
+        return self._batch_check(f"{ref}^{{commit}}")
+
+    def rev_parse(self, ref: str) -> str:
+        sha = self.resolve(ref)
+        if sha is None:
+            raise ValueError(f"Unknown revision {ref}")
+        return sha
+
+    @staticmethod
+    def is_ancestor(ancestor: str, descendant: str) -> bool:
+        """False also when `ancestor` is unknown, e.g. after history was rewritten"""
+        result = subprocess.run(
+            ["git", "merge-base", "--is-ancestor", ancestor, descendant],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
         )
+        return result.returncode == 0
+
+    @staticmethod
+    def refs(*patterns: str) -> Dict[str, str]:
+        """{ref name: object name} of refs matching `patterns`, e.g. `refs/tags`"""
+        output = subprocess.check_output(
+            ["git", "for-each-ref", "--format=%(refname) %(objectname)", *patterns],
+            universal_newlines=True,
+        )
+        return dict(line.split(" ", 1) for line in output.splitlines())
+
+    def config(self, key: str) -> Optional[str]:
+        """Value of git config `key`, whole config is read once"""
+        if self._config is None:
+            output = subprocess.check_output(
+                ["git", "config", "-z", "--list"], universal_newlines=True
+            )
+            config = {}
+            for entry in output.split("\0"):
+                name, _, value = entry.partition("\n")
+                # listed from system to local config, the last value wins
+                config[name] = value
+            self._config = config
+        return self._config.get(key.lower())
+
+    def _close(self):
+        if self._cat_file is not None:
+            self._cat_file.stdin.close()
+            self._cat_file.wait()
+            self._cat_file = None
+
+    def close(self):
+        """Stop git processes and forget config, e.g. before switching repository"""
+        with self._lock:
+            self._close()
+            self._config = None
+
+
+GIT = GitBackend()
+atexit.register(GIT.close)
+
+
+class FetchCoordinator:
+    """
+    Fetches only branches which commands of a run need, once per run:
+    flows and make-links ask for a fetch, the first call fetches all of them
+    with exact refspecs, the following ones do nothing.
+    Branches which are not changed on remote are not fetched at all.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fetched: Set[str] = set()
+
+    @staticmethod
+    def get_branches(settings: Settings) -> Set[str]:
+        branches = set()
+        if settings.require_creation_of_release_branch:
+            branches.add(settings.git.base)
+        if settings.require_creation_of_hotfix_branch:
+            branches.add(settings.git.master)
+        if (
+            settings.require_jira_links
+            or settings.require_release_notes
+            or settings.require_merge_to_master
+        ):
+            branches.add(settings.git.master)
+            # made by this run otherwise, it doesn't exist on remote yet
+            if not (
+                settings.require_creation_of_release_branch
+                or settings.require_creation_of_hotfix_branch
+            ):
+                branches.add(settings.release_branch_name)
+        if settings.require_merge_to_develop:
+            branches |= {settings.git.master, settings.git.base}
+        return branches
+
+    def fetch(self, settings: Settings):
+        with self._lock:
+            branches = self.get_branches(settings) - self._fetched
+            if branches:
+                self._fetch(settings.git, sorted(branches))
+                self._fetched |= branches
+
+    def reset(self):
+        """Forget fetched branches, e.g. before switching repository"""
+        with self._lock:
+            self._fetched.clear()
+
+    @staticmethod
+    def _fetch(git_settings: GitSettings, branches: List[str]):
+        remote_refs = {}
+        output = GitFuncs.ls_remote(refs=[f"refs/heads/{b}" for b in branches])()
+        for line in output.splitlines():
+            sha, _, ref = line.partition("\t")
+            remote_refs[ref[len("refs/heads/") :]] = sha
+
+        local_refs = GIT.refs(*[f"refs/remotes/origin/{b}" for b in branches])
+        missing = [branch for branch in branches if branch not in remote_refs]
+        changed = [
+            branch
+            for branch in branches
+            if branch in remote_refs
+            and remote_refs[branch] != local_refs.get(f"refs/remotes/origin/{branch}")
+        ]
+
+        if missing:
+            print(f"Branches are not found on remote: {', '.join(missing)}")
+        if not changed:
+            print("Branches are up to date, nothing to fetch")
+            return
+
+        options = []
+        if git_settings.fetch_filter:
+            options.append(f"--filter={git_settings.fetch_filter}")
+
+        GitFuncs.fetch_branches(
+            options=options,
+            refspecs=[f"+refs/heads/{b}:refs/remotes/origin/{b}" for b in changed],
+        )()
+
+
+FETCH = FetchCoordinator()
+
+
+class Commit(NamedTuple):
+    sha: str
+    subject: str
+    body: str
+
+    @property
+    def lines(self) -> Iterator[str]:
+        yield self.subject
+        yield from self.body.split("\n")
+
+
+def iter_commits(*revisions: str) -> Iterator[Commit]:
+    """
+    Stream commits of `git log` one by one as they are read,
+    without keeping the whole log in memory
+    """
+    process = subprocess.Popen(
+        # raw message: %s joins lines of the first paragraph
+        ["git", "log", "-z", "--format=%H%n%B", *revisions],
+        stdout=subprocess.PIPE,
+    )
+
+    try:
+        buffer = b""
+        for chunk in iter(lambda: process.stdout.read(LOG_CHUNK_SIZE), b""):
+            *records, buffer = (buffer + chunk).split(b"\0")
+            for record in records:
+                yield _parse_commit(record)
+
+        if buffer:
+            yield _parse_commit(buffer)
+    finally:
+        process.stdout.close()
+        return_code = process.wait()
+
+    if return_code:
+        raise subprocess.CalledProcessError(return_code, process.args)
+
+
+def _parse_commit(record: bytes) -> Commit:
+    sha, _, message = record.decode("utf-8", errors="replace").partition("\n")
+    subject, _, body = message.partition("\n")
+    return Commit(sha=sha, subject=subject, body=body.rstrip("\n"))
+
+
+class CommitNote(NamedTuple):
+    tasks: Set[str]
+    pull_requests_without_task: Set[int]
+
+    def __str__(self):
+        return "tasks: {}\npulls-without-task: {}\n".format(
+            " ".join(sorted(self.tasks)),
+            " ".join(map(str, sorted(self.pull_requests_without_task))),
+        )
+
+    @classmethod
+    def parse(cls, text: str) -> "CommitNote":
+        values = dict(line.partition(":")[::2] for line in text.splitlines())
+        return cls(
+            tasks=set(values.get("tasks", "").split()),
+            pull_requests_without_task={
+                int(pr) for pr in values.get("pulls-without-task", "").split()
+            },
+        )
+
+
+class TaskNotes:
+    """
+    Tasks resolved for commits are shared between clones via git notes,
+    so only commits without a note have to be resolved with GitHub.
+    Failing to fetch or push notes is not fatal: they are just a cache.
+    """
+
+    def __init__(self, ref: str):
+        self.ref = ref if ref.startswith("refs/") else f"refs/notes/{ref}"
+
+    def _git(self, *args, **kwargs) -> subprocess.CompletedProcess:
+        return subprocess.run(
+            ["git", *args],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            **kwargs,
+        )
+
+    def fetch(self):
+        result = self._git("fetch", "-q", "origin", f"+{self.ref}:{self.ref}")
+        if result.returncode:
+            print(f"Could not fetch notes {self.ref}: {result.stdout.strip()}")
+
+    def read(self, *revisions: str) -> Dict[str, CommitNote]:
+        """Read notes of all commits in range with a single `git log` call"""
+        result = self._git(
+            "log", "-z", f"--notes={self.ref}", "--format=%H%n%N", *revisions
+        )
+        if result.returncode:
+            print(f"Could not read notes {self.ref}: {result.stdout.strip()}")
+            return {}
+
+        notes = {}
+        for record in result.stdout.split("\0"):
+            sha, _, text = record.strip().partition("\n")
+            if text.strip():
+                notes[sha] = CommitNote.parse(text)
+        return notes
+
+    def add(self, sha: str, note: CommitNote):
+        self._git(
+            "notes", f"--ref={self.ref}", "add", "-f", "-F", "-", sha, input=str(note)
+        )
+
+    def push(self):
+        result = self._git("push", "-q", "origin", f"{self.ref}:{self.ref}")
+        if result.returncode:
+            print_error(f"Could not push notes {self.ref}: {result.stdout.strip()}")
 
 
 def execute_commands(name, *commands: BashFunc):
@@ -1,69 +1,407 @@
 import re
-import subprocess
-from typing import List, NamedTuple
+import threading
+from multiprocessing.pool import ThreadPool
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
 
-from github import Github
+from github import Github, GithubException
 
 from . import git
+from .cache import PullRequestCache
+from .common import print_error
 from .conf import Settings
+from .governor import RequestGovernor
+from .profiling import PROFILER
+from .transport import attach_to_github
 
 
 PR_RE = re.compile(r"#(\d+)", flags=re.U | re.I)
 REPO_RE = re.compile(r"[/:]([-\w_]+/[-\w_]+)\.git")
 
+# commits per page of compare endpoint, max allowed by GitHub
+COMPARE_PAGE_SIZE = 100
+
+PULL_REQUESTS_TITLES_QUERY = """
+query($owner: String!, $name: String!) {{
+  repository(owner: $owner, name: $name) {{
+    {fields}
+  }}
+}}
+"""
+
+
+class PullInfo(NamedTuple):
+    number: int
+    title: str
+    merge_commit_sha: Optional[str]
+    merged: bool
+
 
 class GetTaskResponse(NamedTuple):
     tasks: List[str]
     pull_requests_without_task: List[int]
+    # last scanned commit of release branch
+    head: Optional[str] = None
+
+
+# clients by token and governor of all of them: PyGithub connection class is
+# process-wide. They are shared by runs in the same process, e.g. in fleet mode
+_CLIENTS: Dict[str, Github] = {}
+_GOVERNOR: Optional[RequestGovernor] = None
+_CLIENTS_LOCK = threading.Lock()
+
 
+def _get_client(settings: Settings) -> Tuple[Github, RequestGovernor]:
+    global _GOVERNOR
 
+    with _CLIENTS_LOCK:
+        if _GOVERNOR is None:
+            _GOVERNOR = RequestGovernor("GitHub", settings.http)
+            attach_to_github(_GOVERNOR, settings.http)
+        if settings.github.token not in _CLIENTS:
+            _CLIENTS[settings.github.token] = Github(settings.github.token)
+        return _CLIENTS[settings.github.token], _GOVERNOR
+
+
+@PROFILER.instrument("github")
 class GitHubAPI:
     def __init__(self, settings: Settings):
-        self._api = Github(settings.github.token)
+        self._api, self._governor = _get_client(settings)
+        self._settings = settings
         self._master_branch_name = settings.git.master
-        self._release_branch_name = settings.release_branch_name
         self._task_re = re.compile(settings.github.task_re, flags=re.U | re.I)
-        self.repository = self._get_repository()
+        self._pr_batch_size = int(settings.github.pr_batch_size or 0)
+        self._cache = PullRequestCache(settings.cache)
+        # commits are read via GitHub API, without a local clone
+        self._remote = settings.remote
+        self._notes = (
+            git.TaskNotes(settings.git.notes_ref)
+            if settings.git.notes_ref and not self._remote
+            else None
+        )
+        self._repository_name = settings.github.repository or None
+        self._repository = None
+
+    @property
+    def _release_branch_name(self) -> str:
+        # version is not known yet when client is made by steps not needing it
+        return self._settings.release_branch_name
+
+    @property
+    def repository_name(self) -> str:
+        """`owner/name` of GitHub repository, from config or origin remote"""
+        if self._repository_name is None:
+            github_repo_match = REPO_RE.search(
+                git.GIT.config("remote.origin.url") or ""
+            )
+            if not github_repo_match:
+                print_error(
+                    "GitHub repository is not found in origin remote,"
+                    " set it as `github.repository` in config"
+                )
+                exit(1)
+            self._repository_name = github_repo_match.group(1)
+        return self._repository_name
+
+    @property
+    def repository(self):
+        """Lazy repository: it makes no request until its attributes are used"""
+        if self._repository is None:
+            self._repository = self._api.get_repo(self.repository_name, lazy=True)
+        return self._repository
+
+    def get_pull_info(self, pr: int) -> PullInfo:
+        """
+        Get PR metadata, from local cache if possible:
+        stale entries are revalidated with conditional requests,
+        which are not counted against GitHub rate limit
+        """
+        repository_name = self.repository_name
+        cached = self._cache.get(repository_name, pr)
+        if cached and self._cache.is_fresh(cached):
+            return PullInfo(pr, cached.title, cached.merge_commit_sha, cached.merged)
 
-    def _get_repository(self):
-        github_repo_match = REPO_RE.search(
-            subprocess.check_output("git remote -v", shell=True).decode("utf-8")
+        headers = {"If-None-Match": cached.etag} if cached and cached.etag else {}
+        response_headers, data = self.repository._requester.requestJsonAndCheck(
+            "GET", f"/repos/{repository_name}/pulls/{pr}", headers=headers
         )
-        assert github_repo_match
-        return self._api.get_repo(github_repo_match.group(1))
+
+        if data is None:
+            # 304 Not Modified
+            self._cache.touch(repository_name, pr)
+            return PullInfo(pr, cached.title, cached.merge_commit_sha, cached.merged)
+
+        pull = PullInfo(
+            number=pr,
+            title=data["title"],
+            merge_commit_sha=data.get("merge_commit_sha"),
+            merged=bool(data.get("merged")),
+        )
+        self._cache.put(repository_name, *pull, etag=response_headers.get("etag"))
+        return pull
+
+    def get_pulls_info(self, prs: Iterable[int]) -> List[PullInfo]:
+        """Get metadata of many PRs concurrently, in order of `prs`"""
+        prs = list(prs)
+        # lazy repository is resolved before threads use it
+        self.repository
+        with ThreadPool(min(self._governor.max_concurrency, len(prs)) or 1) as pool:
+            return pool.map(self.get_pull_info, prs)
 
     def get_pr_task(self, pr):
-        pull = self.repository.get_pull(pr)
-        return self._task_re.findall(pull.title)
+        return self._task_re.findall(self.get_pull_info(pr).title)
+
+    def get_prs_titles(self, prs: Iterable[int]) -> Dict[int, str]:
+        """
+        Resolve titles of many pull requests at once:
+        they are requested with batched GraphQL queries instead of a REST call per PR
+        """
+        titles = {}
+        not_cached = []
+        for pr in sorted(set(prs)):
+            cached = self._cache.get(self.repository_name, pr)
+            # stale entries with ETag are revalidated by (free) conditional requests
+            if not self._pr_batch_size or (cached and cached.etag):
+                titles[pr] = self.get_pull_info(pr).title
+            elif cached and self._cache.is_fresh(cached):
+                titles[pr] = cached.title
+            else:
+                not_cached.append(pr)
+
+        batches = (
+            not_cached[offset : offset + self._pr_batch_size]
+            for offset in range(0, len(not_cached), self._pr_batch_size or 1)
+        )
+        for batch in batches:
+            titles.update(self._get_pr_titles(batch))
+        return titles
+
+    def get_prs_tasks(self, prs: Iterable[int]) -> Dict[int, List[str]]:
+        return {
+            pr: self._task_re.findall(title)
+            for pr, title in self.get_prs_titles(prs).items()
+        }
+
+    def _get_pr_titles(self, prs: List[int]) -> Dict[int, str]:
+        repository_name = self.repository_name
+        owner, name = repository_name.split("/")
+        query = PULL_REQUESTS_TITLES_QUERY.format(
+            fields="\n    ".join(
+                f"pr{pr}: pullRequest(number: {pr})"
+                f" {{ title merged mergeCommit {{ oid }} }}"
+                for pr in prs
+            )
+        )
+        _, response = self.repository._requester.requestJsonAndCheck(
+            "POST",
+            "/graphql",
+            input={"query": query, "variables": {"owner": owner, "name": name}},
+        )
+
+        # unknown numbers (e.g. issues) are reported as NOT_FOUND errors and
+        # resolved to null, other errors (e.g. RATE_LIMITED) may come with 200
+        errors = response.get("errors") or []
+        failed = [error for error in errors if error.get("type") != "NOT_FOUND"]
+        if failed or not response.get("data"):
+            messages = "; ".join(
+                error.get("message", str(error)) for error in failed or errors
+            )
+            raise RuntimeError(
+                f"GitHub failed to resolve pull requests: {messages or 'no data'}"
+            )
+        repository = response["data"].get("repository") or {}
+        not_found = {
+            error["path"][-1] for error in errors if len(error.get("path") or ()) == 2
+        }
+
+        titles = {}
+        for pr in prs:
+            pull = repository.get(f"pr{pr}")
+            if not pull:
+                if f"pr{pr}" not in not_found:
+                    raise RuntimeError(f"GitHub didn't resolve pull request {pr}")
+                titles[pr] = ""
+                continue
+
+            titles[pr] = pull["title"]
+            merge_commit_sha = (pull.get("mergeCommit") or {}).get("oid")
+            self._cache.put(
+                repository_name, pr, pull["title"], merge_commit_sha, pull["merged"]
+            )
+        return titles
 
-    def get_commit_message_in_release(self):
-        git.GitFuncs.fetch()()
-        return subprocess.check_output(
-            "git log origin/{}..origin/{} --pretty=%B".format(
-                self._master_branch_name, self._release_branch_name
-            ),
-            shell=True,
-        ).decode("utf-8")
+    def _get_release_revisions(self, since: Optional[str] = None) -> List[str]:
+        """
+        Revisions of commits in release branch but not in master,
+        only added after `since` if it is still part of release branch history
+        """
+        head = git.GIT.rev_parse(f"origin/{self._release_branch_name}")
+        revisions = [head, f"^origin/{self._master_branch_name}"]
 
-    def get_related_tasks(self):
-        commit_messages = self.get_commit_message_in_release()
+        if since and git.GIT.is_ancestor(since, head):
+            print(f"Scanning commits added after {since}")
+            revisions.append(f"^{since}")
+        elif since:
+            print("Release branch history was rewritten, scanning all commits")
+
+        return revisions
+
+    def get_commit_message_in_release(
+        self, revisions: List[str]
+    ) -> Iterator[git.Commit]:
+        """Stream commits of release branch"""
+        return git.iter_commits(*revisions)
+
+    def _get_remote_release_commits(
+        self, since: Optional[str] = None
+    ) -> Tuple[str, Iterator[git.Commit]]:
+        """
+        Head of release branch and stream of its commits not in master, read
+        page by page from compare endpoint; like `_get_release_revisions`,
+        only ones added after `since` if it is still part of release branch history
+        """
+        requester = self.repository._requester
+        _, ref = requester.requestJsonAndCheck(
+            "GET",
+            f"/repos/{self.repository_name}/git/ref/heads/{self._release_branch_name}",
+        )
+        head = ref["object"]["sha"]
+
+        first_page = None
+        base = self._master_branch_name
+        if since:
+            try:
+                first_page = self._get_compare_page(since, head, 1)
+            except GithubException:
+                # unknown commit
+                first_page = None
+
+            if first_page and first_page["status"] in ("ahead", "identical"):
+                print(f"Scanning commits added after {since}")
+                base = since
+            else:
+                print("Release branch history was rewritten, scanning all commits")
+                first_page = None
+
+        return head, self._iter_compare_commits(base, head, first_page)
+
+    def _get_compare_page(self, base: str, head: str, page: int) -> dict:
+        _, data = self.repository._requester.requestJsonAndCheck(
+            "GET",
+            f"/repos/{self.repository_name}/compare/{base}...{head}",
+            parameters={"per_page": COMPARE_PAGE_SIZE, "page": page},
+        )
+        return data
+
+    def _iter_compare_commits(
+        self, base: str, head: str, first_page: Optional[dict] = None
+    ) -> Iterator[git.Commit]:
+        page_number = 1
+        page = first_page or self._get_compare_page(base, head, page_number)
+        read = 0
+        while True:
+            for item in page["commits"]:
+                subject, _, body = item["commit"]["message"].partition("\n")
+                yield git.Commit(item["sha"], subject, body.strip("\n"))
+
+            read += len(page["commits"])
+            if (
+                len(page["commits"]) < COMPARE_PAGE_SIZE
+                or read >= page["total_commits"]
+            ):
+                return
+
+            page_number += 1
+            page = self._get_compare_page(base, head, page_number)
+
+    def _parse_commit_message(self, commit: git.Commit) -> Tuple[Set[str], Set[int]]:
+        """Tasks mentioned in commit message and PRs to look tasks up in"""
+        tasks = set()
+        pulls = set()
+
+        for line in commit.lines:
+            line_tasks = self._task_re.findall(line)
+            pull_request_match = PR_RE.search(line)
+
+            if pull_request_match and not line_tasks:
+                pulls.add(int(pull_request_match.group(1)))
+
+            tasks |= {task.upper() for task in line_tasks}
+
+        return tasks, pulls
+
+    def get_related_tasks(self, since: Optional[str] = None):
+        """
+        Tasks of commits in release branch, pass `since` (previously scanned
+        head of release branch) to get only tasks of commits added after it
+        """
+        notes = {}
+        if self._remote:
+            head, commits = self._get_remote_release_commits(since)
+        else:
+            git.FETCH.fetch(self._settings)
+            revisions = self._get_release_revisions(since)
+            head = revisions[0]
+            commits = self.get_commit_message_in_release(revisions)
+
+            if self._notes:
+                self._notes.fetch()
+                notes = self._notes.read(*revisions)
 
         all_tasks = set()
         left_pulls = set()
+        unresolved_commits = {}
 
-        for line in commit_messages.split("\n"):
-            tasks = self._task_re.findall(line)
-            pull_request_match = PR_RE.search(line)
+        # PRs are resolved in background while the log is still being read
+        batch_size = self._pr_batch_size or 1
+        pending_pulls = set()
+        requested_pulls = set()
+        lookups = []
+
+        with ThreadPool(self._governor.max_concurrency) as pool:
+            for commit in commits:
+                if commit.sha in notes:
+                    all_tasks |= notes[commit.sha].tasks
+                    left_pulls |= notes[commit.sha].pull_requests_without_task
+                    continue
+
+                tasks, pulls = self._parse_commit_message(commit)
+                all_tasks |= tasks
+                if not pulls:
+                    continue
+
+                unresolved_commits[commit.sha] = (tasks, pulls)
+                pending_pulls |= pulls - requested_pulls
+                requested_pulls |= pulls
+                if len(pending_pulls) >= batch_size:
+                    lookups.append(
+                        pool.apply_async(self.get_prs_tasks, (pending_pulls,))
+                    )
+                    pending_pulls = set()
+
+            if pending_pulls:
+                lookups.append(pool.apply_async(self.get_prs_tasks, (pending_pulls,)))
+
+            prs_tasks = {}
+            for lookup in lookups:
+                prs_tasks.update(lookup.get())
+
+        for sha, (tasks, pulls) in unresolved_commits.items():
+            pulls_tasks = {task.upper() for pr in pulls for task in prs_tasks[pr]}
+            pulls_without_task = {pr for pr in pulls if not prs_tasks[pr]}
+
+            all_tasks |= pulls_tasks
+            left_pulls |= pulls_without_task
 
-            if pull_request_match and not tasks:
-                pr_number = int(pull_request_match.group(1))
-                tasks = self.get_pr_task(pr=pr_number)
-                if not tasks:
-                    left_pulls.add(pr_number)
+            if self._notes:
+                self._notes.add(
+                    sha, git.CommitNote(tasks | pulls_tasks, pulls_without_task)
+                )
 
-            all_tasks |= {task.upper() for task in tasks}
+        if self._notes and unresolved_commits:
+            self._notes.push()
 
         return GetTaskResponse(
             tasks=list(sorted(all_tasks)),
             pull_requests_without_task=list(sorted(left_pulls)),
+            head=head,
         )
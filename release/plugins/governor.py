@@ -0,0 +1,182 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import NamedTuple, Optional
+
+from requests import Response
+
+from .conf import HttpSettings
+
+
+__all__ = ["RequestGovernor", "Retry"]
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+RETRIABLE_STATUSES = frozenset({500, 502, 503, 504})
+# successful responses in a row after which concurrency is increased back
+RECOVERY_STREAK = 20
+
+
+class Retry(NamedTuple):
+    delay: float
+    # asked for by service (Retry-After, rate limit reset), not counted as a retry
+    by_server: bool = False
+
+
+class RequestGovernor:
+    """
+    Paces requests to a single service:
+    * token bucket limits request rate
+    * concurrency limit is halved when service throttles and restored on success
+    * throttled requests (429, GitHub secondary rate limit) are retried regardless
+      of method, as they were not processed; failed idempotent requests are retried
+      with jittered exponential backoff, waits asked for by service are
+      not limited by backoff and don't count as retries
+    """
+
+    def __init__(self, name: str, settings: HttpSettings):
+        self.name = name
+        self._rate = float(settings.rate)
+        self._burst = float(settings.burst)
+        self._max_concurrency = int(settings.concurrency)
+        self._max_retries = int(settings.max_retries)
+        self._max_backoff = float(settings.max_backoff)
+        self._max_wait = float(settings.max_wait)
+
+        self._lock = threading.Condition()
+        self._tokens = self._burst
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._concurrency = self._max_concurrency
+        self._in_flight = 0
+        self._success_streak = 0
+
+    @property
+    def max_concurrency(self) -> int:
+        return self._max_concurrency
+
+    def _acquire(self):
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._burst, self._tokens + (now - self._refilled_at) * self._rate
+                )
+                self._refilled_at = now
+
+                wait = max(self._paused_until - now, 0.0)
+                if not wait and self._tokens < 1:
+                    wait = (1 - self._tokens) / self._rate
+                if not wait and self._in_flight < self._concurrency:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    return
+
+                # woken up earlier when a slot is released
+                self._lock.wait(wait or None)
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._lock.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """Wait for a permission to send a request"""
+        self._acquire()
+        try:
+            yield
+        finally:
+            self._release()
+
+    def retry_delay(
+        self,
+        method: str,
+        response: Optional[Response],
+        attempt: int,
+        waited: float = 0.0,
+    ) -> Optional[Retry]:
+        """
+        Delay before retrying request or None if it shouldn't be retried,
+        `response` is None if request failed with a connection error;
+        `attempt` is number of retries made and `waited` is seconds of waits
+        asked for by service
+        """
+        throttled = response is not None and _is_throttled(response)
+        if throttled:
+            self._on_throttled()
+        elif response is not None and response.status_code < 400:
+            self._on_success()
+
+        if not throttled:
+            retriable = response is None or response.status_code in RETRIABLE_STATUSES
+            if not (retriable and method.upper() in IDEMPOTENT_METHODS):
+                return None
+
+        delay = _get_server_delay(response) if response is not None else None
+        if delay is not None:
+            # e.g. GitHub primary rate limit is reset in up to an hour
+            if waited + delay > self._max_wait:
+                print(f"{self.name}: asked to wait {delay:.0f}s, giving up {method}")
+                return None
+            retry = Retry(delay, by_server=True)
+        elif attempt >= self._max_retries:
+            return None
+        else:
+            # "full jitter" backoff
+            retry = Retry(random.uniform(0, min(self._max_backoff, 2**attempt)))
+
+        delay = retry.delay
+        if throttled:
+            # hold all requests to the service, not only the throttled one
+            with self._lock:
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+        print(f"{self.name}: retrying {method} in {delay:.1f}s (attempt {attempt + 1})")
+        return retry
+
+    def _on_throttled(self):
+        with self._lock:
+            self._concurrency = max(1, self._concurrency // 2)
+            self._success_streak = 0
+
+    def _on_success(self):
+        with self._lock:
+            self._success_streak += 1
+            if (
+                self._success_streak >= RECOVERY_STREAK
+                and self._concurrency < self._max_concurrency
+            ):
+                self._concurrency += 1
+                self._success_streak = 0
+                self._lock.notify_all()
+
+
+def _is_throttled(response: Response) -> bool:
+    if response.status_code == 429:
+        return True
+
+    # GitHub reports both primary and secondary rate limits with 403
+    return response.status_code == 403 and (
+        response.headers.get("X-RateLimit-Remaining") == "0"
+        or "Retry-After" in response.headers
+        or "rate limit" in response.text.lower()
+    )
+
+
+def _get_server_delay(response: Response) -> Optional[float]:
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            return max(
+                parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0
+            )
+
+    reset = response.headers.get("X-RateLimit-Reset")
+    if reset and response.headers.get("X-RateLimit-Remaining") == "0":
+        return max(float(reset) - time.time(), 0.0)
+
+    return None
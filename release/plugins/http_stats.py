@@ -0,0 +1,182 @@
+import json
+import re
+import threading
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+
+__all__ = ["HTTP_STATS", "HttpStats", "get_endpoint"]
+
+# seconds, upper bounds of latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+# order matters: more specific patterns go first
+ENDPOINT_PATTERNS = [
+    (re.compile(r"^/repos/[^/]+/[^/]+"), "/repos/{r}"),
+    (re.compile(r"/compare/[^/]+$"), "/compare/{range}"),
+    (re.compile(r"/[A-Za-z][A-Za-z0-9_]*-\d+(?=/|$)"), "/{key}"),
+    (re.compile(r"/[0-9a-f]{40}(?=/|$)"), "/{sha}"),
+    (re.compile(r"/\d+(?=/|$)"), "/{n}"),
+]
+
+# versioned API prefixes are kept as is
+API_PREFIX_RE = re.compile(r"^/rest/\w+/\d+|^/api/v3")
+
+PROMETHEUS_PREFIX = "release_tool_http"
+
+
+def get_endpoint(method: str, url: str) -> str:
+    """Request template, e.g. `GET /repos/{r}/pulls/{n}`"""
+    path = urlsplit(url).path
+    prefix_match = API_PREFIX_RE.match(path)
+    prefix = prefix_match.group(0) if prefix_match else ""
+
+    path = path[len(prefix) :]
+    for pattern, replacement in ENDPOINT_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return f"{method} {prefix}{path}"
+
+
+class EndpointStats:
+    __slots__ = (
+        "requests",
+        "statuses",
+        "bytes_out",
+        "bytes_in",
+        "retries",
+        "latency_sum",
+        "latency_buckets",
+    )
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses = Counter()
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.retries = 0
+        self.latency_sum = 0.0
+        # not cumulative, count of requests per bucket
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+
+    def to_json(self) -> dict:
+        return {
+            "requests": self.requests,
+            "statuses": dict(self.statuses),
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+            "retries": self.retries,
+            "latency_sum": round(self.latency_sum, 6),
+            "latency_buckets": {
+                _format_bound(bound): count
+                for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets)
+            },
+        }
+
+
+class HttpStats:
+    """
+    Counts outgoing Jira and GitHub requests per endpoint template (`--http-stats`),
+    dumped at exit as JSON or, for `.prom` files, as Prometheus textfile
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        # {(service, endpoint): stats}
+        self._endpoints: Dict[Tuple[str, str], EndpointStats] = {}
+
+    def record(
+        self,
+        service: str,
+        method: str,
+        url: str,
+        status: Optional[int],
+        bytes_out: int,
+        bytes_in: int,
+        retries: int,
+        latency: float,
+    ):
+        if not self.enabled:
+            return
+
+        key = (service, get_endpoint(method, url))
+        with self._lock:
+            stats = self._endpoints.setdefault(key, EndpointStats())
+            stats.requests += 1
+            stats.statuses[str(status) if status else "error"] += 1
+            stats.bytes_out += bytes_out
+            stats.bytes_in += bytes_in
+            stats.retries += retries
+            stats.latency_sum += latency
+            stats.latency_buckets[bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def save(self, path: str):
+        with open(path, "w") as fo:
+            if path.endswith(".prom"):
+                fo.write(self.to_prometheus())
+            else:
+                json.dump(self.to_json(), fo, indent=2)
+        total = sum(stats.requests for stats in self._endpoints.values())
+        print(f"HTTP statistics of {total} requests are saved to {path}")
+
+    def to_json(self) -> dict:
+        return {
+            "endpoints": [
+                {"service": service, "endpoint": endpoint, **stats.to_json()}
+                for (service, endpoint), stats in sorted(self._endpoints.items())
+            ]
+        }
+
+    def to_prometheus(self) -> str:
+        metrics = {
+            "requests_total": ("counter", "Requests by response status"),
+            "request_bytes_total": ("counter", "Bytes of request bodies"),
+            "response_bytes_total": ("counter", "Bytes of response bodies"),
+            "retries_total": ("counter", "Retries of requests"),
+            "request_duration_seconds": ("histogram", "Latency including retries"),
+        }
+        samples = {name: [] for name in metrics}
+
+        for (service, endpoint), stats in sorted(self._endpoints.items()):
+            method, _, path = endpoint.partition(" ")
+            labels = f'service="{service}",method="{method}",endpoint="{_escape(path)}"'
+
+            for status, count in sorted(stats.statuses.items()):
+                samples["requests_total"].append(
+                    f'{{{labels},status="{status}"}} {count}'
+                )
+            samples["request_bytes_total"].append(f"{{{labels}}} {stats.bytes_out}")
+            samples["response_bytes_total"].append(f"{{{labels}}} {stats.bytes_in}")
+            samples["retries_total"].append(f"{{{labels}}} {stats.retries}")
+
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, stats.latency_buckets):
+                cumulative += count
+                samples["request_duration_seconds"].append(
+                    f'_bucket{{{labels},le="{_format_bound(bound)}"}} {cumulative}'
+                )
+            samples["request_duration_seconds"] += [
+                f"_sum{{{labels}}} {stats.latency_sum:.6f}",
+                f"_count{{{labels}}} {stats.requests}",
+            ]
+
+        lines = []
+        for name, (metric_type, description) in metrics.items():
+            full_name = f"{PROMETHEUS_PREFIX}_{name}"
+            lines.append(f"# HELP {full_name} {description}")
+            lines.append(f"# TYPE {full_name} {metric_type}")
+            lines += [f"{full_name}{sample}" for sample in samples[name]]
+        return "\n".join(lines) + "\n"
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else str(bound)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+HTTP_STATS = HttpStats()
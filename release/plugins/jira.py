@@ -1,15 +1,140 @@
-from datetime import datetime
+import json
+import threading
+import time
 from functools import partial
 from multiprocessing.pool import ThreadPool
-from typing import Optional
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
 
 from jira import JIRA
+from jira.exceptions import JIRAError
 from jira.resources import Project, Version
 
+from .cassette import CASSETTE
 from .common import print_error, print_title
 from .conf import Settings
+from .governor import RequestGovernor
+from .profiling import PROFILER
+from .transport import attach_to_session
+
+
+SEARCH_PAGE_SIZE = 100
+# keys per `key in (...)` query, to keep URL short
+SEARCH_KEYS_CHUNK = 100
+# Jira Cloud bulk edit endpoint accepts up to 1000 issues per request
+BULK_EDIT_URL = "{server}/rest/api/3/{path}"
+BULK_EDIT_LIMIT = 1000
+# seconds, to wait for bulk edit task and between checks of its status
+BULK_EDIT_TIMEOUT = 120
+BULK_EDIT_POLL_INTERVAL = 1
+
+
+# clients by connection and unreleased versions by (server, project), shared by
+# runs in the same process, e.g. in fleet mode
+_CLIENTS: Dict[Tuple[str, str, str], Tuple[JIRA, RequestGovernor]] = {}
+_UNRELEASED_VERSIONS: Dict[Tuple[str, str], Tuple[Project, List[Version]]] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _get_client(settings: Settings) -> Tuple[JIRA, RequestGovernor]:
+    connection = settings.jira.connection
+    key = (connection.server, connection.user, connection.token)
+    with _CLIENTS_LOCK:
+        if key not in _CLIENTS:
+            # server info is requested after session is governed, like all requests
+            api = JIRA(
+                {"server": connection.server},
+                basic_auth=(connection.user, connection.token),
+                get_server_info=False,
+                # governor retries, only requests which are safe to repeat
+                max_retries=0,
+            )
+            governor = RequestGovernor("Jira", settings.http)
+            attach_to_session(api._session, governor, settings.http)
+            server_info = api.server_info()
+            api._version = tuple(server_info["versionNumbers"])
+            api.deploymentType = server_info.get("deploymentType")
+            _CLIENTS[key] = api, governor
+        return _CLIENTS[key]
+
+
+class VersionRecord(NamedTuple):
+    id: str
+    name: str
+    released: bool
+
+
+class LinkRecord(NamedTuple):
+    # link type name and its inward/outward descriptions
+    type_names: Tuple[str, str, str]
+    key: str
+
+
+class IssueRecord:
+    """
+    Lightweight representation of an issue, parsed from raw JSON.
+    Only fields requested from Jira are filled in, see JiraAPI._search
+    """
+
+    __slots__ = (
+        "key",
+        "summary",
+        "status",
+        "issuetype",
+        "components",
+        "fix_versions",
+        "links",
+        "transitions",
+    )
+
+    def __init__(
+        self,
+        key: str,
+        summary: Optional[str] = None,
+        status: Optional[str] = None,
+        issuetype: Optional[str] = None,
+        components: Tuple[str, ...] = (),
+        fix_versions: Tuple[VersionRecord, ...] = (),
+        links: Tuple[LinkRecord, ...] = (),
+        transitions: Optional[List[dict]] = None,
+    ):
+        self.key = key
+        self.summary = summary
+        self.status = status
+        self.issuetype = issuetype
+        self.components = components
+        self.fix_versions = fix_versions
+        self.links = links
+        self.transitions = transitions
+
+    @classmethod
+    def from_raw(cls, raw: dict) -> "IssueRecord":
+        fields = raw.get("fields") or {}
+        return cls(
+            key=raw["key"],
+            summary=fields.get("summary"),
+            status=(fields.get("status") or {}).get("name"),
+            issuetype=(fields.get("issuetype") or {}).get("name"),
+            components=tuple(c["name"] for c in fields.get("components") or ()),
+            fix_versions=tuple(
+                VersionRecord(v["id"], v["name"], v.get("released", False))
+                for v in fields.get("fixVersions") or ()
+            ),
+            links=tuple(
+                LinkRecord(
+                    type_names=(
+                        link["type"]["name"],
+                        link["type"]["inward"],
+                        link["type"]["outward"],
+                    ),
+                    key=(link.get("outwardIssue") or link.get("inwardIssue"))["key"],
+                )
+                for link in fields.get("issuelinks") or ()
+            ),
+            transitions=raw.get("transitions"),
+        )
 
 
+@PROFILER.instrument("jira")
 class JiraAPI:
     """
     Jira client has no documentation, so if you need one, use one for REST API:
@@ -24,10 +149,9 @@ class JiraAPI:
             version=settings.version, component=self.release_task.component
         )
 
-        self._api = JIRA(
-            {"server": settings.jira.connection.server},
-            basic_auth=(settings.jira.connection.user, settings.jira.connection.token),
-        )
+        self._api, self._governor = _get_client(settings)
+        # {(issue type, status): transitions}
+        self._transitions_cache = {}
 
     def _create_version(self, project: Project):
         proposed_name = "Hotfix" if self._settings.version.minor > 0 else "Release"
@@ -69,95 +193,330 @@ class JiraAPI:
         else:
             return unreleased_versions[user_input]
 
-    def get_version(self) -> Optional[Version]:
+    def _get_unreleased_versions(self) -> Tuple[Project, List[Version]]:
+        key = (self._settings.jira.connection.server, self.release_task.project)
+        if key not in _UNRELEASED_VERSIONS:
+            project = self._api.project(self.release_task.project)
+            _UNRELEASED_VERSIONS[key] = (
+                project,
+                [v for v in self._api.project_versions(project) if not v.released],
+            )
+        return _UNRELEASED_VERSIONS[key]
+
+    def get_version(self, name: Optional[str] = None) -> Optional[Version]:
+        """Ask user to select Jira version, unless `name` of existing one is given"""
         print_title(f"Searching for Jira release version")
-        project = self._api.project(self.release_task.project)
+        project, unreleased_versions = self._get_unreleased_versions()
 
-        unreleased_versions = [
-            v for v in self._api.project_versions(project) if not v.released
-        ]
+        if name:
+            for version in unreleased_versions:
+                if version.name == name:
+                    return version
+            print_error(f"Unreleased Jira version {name} is not found")
+            exit(1)
 
         return self._select_version(project, unreleased_versions)
 
-    def _get_jira_release_unfinished_tasks(self, version: Version):
+    def _get_issue(
+        self, key: str, fields: str, expand: Optional[str] = None
+    ) -> IssueRecord:
+        params = {"fields": fields}
+        if expand:
+            params["expand"] = expand
+        return IssueRecord.from_raw(self._api._get_json(f"issue/{key}", params=params))
+
+    def _search(
+        self, jql: str, fields: str, expand: Optional[str] = None
+    ) -> Iterator[IssueRecord]:
+        """Iterate over issues of all pages of search results, only `fields` are requested"""
+        params = {
+            "jql": jql,
+            "fields": fields,
+            "maxResults": SEARCH_PAGE_SIZE,
+            # do not fail whole query because of unknown keys
+            "validateQuery": "warn",
+        }
+        if expand:
+            params["expand"] = expand
+
+        start_at = 0
+        while True:
+            page = self._api._get_json("search", params={**params, "startAt": start_at})
+            issues = page.get("issues", [])
+            yield from map(IssueRecord.from_raw, issues)
+
+            start_at += len(issues)
+            if not issues or start_at >= page.get("total", 0):
+                return
+
+    def _search_keys(
+        self, keys: List[str], fields: str
+    ) -> Iterator[Tuple[List[str], List[IssueRecord]]]:
+        """(chunk of keys, its issues) found by a `key in (...)` search per chunk"""
+        for offset in range(0, len(keys), SEARCH_KEYS_CHUNK):
+            chunk = keys[offset : offset + SEARCH_KEYS_CHUNK]
+            jql = "key in ({})".format(", ".join(chunk))
+            yield chunk, list(self._search(jql, fields=fields))
+
+    def get_issues(self, keys: List[str]) -> Iterator[IssueRecord]:
         """
-        To check that all tasks in Jira release is finished
-        select them using jql
+        Issues for release notes in order of `keys`, chunk by chunk as they are
+        found; unknown keys (e.g. of other Jira) are returned without fields
+        """
+        for chunk, issues in self._search_keys(
+            keys, fields="summary,issuetype,components,status"
+        ):
+            found = {issue.key: issue for issue in issues}
+            for key in chunk:
+                yield found.get(key) or IssueRecord(key)
+
+    def _get_jira_release_unfinished_tasks(
+        self, versions: List[VersionRecord]
+    ) -> Dict[str, List[str]]:
+        """
+        To check that all tasks in Jira releases are finished
+        select them using a single jql, returns {version name: [unfinished keys]}
         """
         final_statuses = '", "'.join(self.transition.child_final_statuses)
         types_to_skip = '", "'.join(self.transition.child_task_types_to_skip)
+        version_names = '", "'.join(version.name for version in versions)
 
-        return self._api.search_issues(
+        unfinished_tasks = {version.name: [] for version in versions}
+        for issue in self._search(
             f'project = "{self.release_task.project}"'
-            f' AND fixVersion = "{version.name}"'
+            f' AND fixVersion in ("{version_names}")'
             f' AND fixVersion in unreleasedVersions("{self.release_task.project}")'
             f' AND status NOT IN ("{final_statuses}")'
-            f' AND type NOT IN ("{types_to_skip}")'
-        )
-
-    def _get_transition(self, issue, transition_name):
-        transitions = [
-            t
-            for t in self._api.transitions(issue)
-            if t["name"].lower() == transition_name.lower()
-        ]
-        if not transitions:
-            return None
+            f' AND type NOT IN ("{types_to_skip}")',
+            fields="fixVersions,status",
+        ):
+            for fix_version in issue.fix_versions:
+                if fix_version.name in unfinished_tasks:
+                    unfinished_tasks[fix_version.name].append(issue.key)
 
-        return transitions[0]
+        return unfinished_tasks
 
     def release_version(self, release_task_key: str):
         print_title(f"Releasing Jira version of release task {release_task_key}")
-        release_task = self._api.issue(release_task_key)
-
-        for version in release_task.fields.fixVersions:
-            version: Version
-            print(f'Checking Jira release version: "{version.name}"...')
+        release_task = self._get_issue(release_task_key, fields="fixVersions")
 
+        unreleased_versions = []
+        for version in release_task.fix_versions:
             if version.released:
-                print_error("Version is already released")
-                continue
+                print_error(
+                    f'Jira release version "{version.name}" is already released'
+                )
+            else:
+                unreleased_versions.append(version)
+
+        if not unreleased_versions:
+            return
+
+        unfinished_tasks = self._get_jira_release_unfinished_tasks(unreleased_versions)
+
+        for version in unreleased_versions:
+            print(f'Checking Jira release version: "{version.name}"...')
 
-            unfinished_tasks = self._get_jira_release_unfinished_tasks(version)
-            if unfinished_tasks:
-                tasks_str = ", ".join([i.key for i in unfinished_tasks])
+            if unfinished_tasks[version.name]:
+                tasks_str = ", ".join(unfinished_tasks[version.name])
                 print_error(
                     f'Can\'t release Jira version: "{version.name}", it has unfinished tasks: {tasks_str}'
                 )
                 continue
 
             print("Jira version is safe to release, releasing...", end=" ")
-            version.update(released=True, releaseDate=_get_formatted_date())
+            self._api._session.put(
+                self._api._get_url(f"version/{version.id}"),
+                data=json.dumps(
+                    {"released": True, "releaseDate": _get_formatted_date()}
+                ),
+            )
             print("Ok!")
 
-    def _add_to_release_version(self, version: Version, release_task_key: str):
-        issue = self._api.issue(release_task_key)
-        issue.add_field_value("fixVersions", {"name": version.name})
+    def _add_to_release_version(self, version: Version, keys: List[str]):
+        """
+        Add version to fixVersions of issues which don't have it yet:
+        current versions are fetched with a few searches instead of a GET per issue
+        """
+        missing_keys = []
+        for _, issues in self._search_keys(keys, fields="fixVersions"):
+            for issue in issues:
+                if version.name not in {v.name for v in issue.fix_versions}:
+                    missing_keys.append(issue.key)
 
-    def make_links(self, version: Optional[Version], release_task_key, related_keys):
+        if not missing_keys:
+            return
+
+        print(f'Adding {len(missing_keys)} tasks to Jira version "{version.name}"')
+        for offset in range(0, len(missing_keys), BULK_EDIT_LIMIT):
+            chunk = missing_keys[offset : offset + BULK_EDIT_LIMIT]
+            if not self._bulk_add_to_release_version(version, chunk):
+                with ThreadPool(self._governor.max_concurrency) as pool:
+                    pool.map(
+                        partial(self._add_issue_to_release_version, version), chunk
+                    )
+
+    def _bulk_add_to_release_version(self, version: Version, keys: List[str]) -> bool:
+        """
+        Use bulk edit endpoint and wait for its task, returns False if endpoint
+        is not available (Jira Server) or not all issues were updated
+        """
+        payload = {
+            "selectedIssueIdsOrKeys": keys,
+            "selectedActions": ["fixVersions"],
+            "editedFieldsInput": {
+                "multipleVersionPickerFields": [
+                    {
+                        "fieldId": "fixVersions",
+                        "bulkEditMultiVersionPickerOption": "ADD",
+                        "versions": [{"versionId": version.id}],
+                    }
+                ]
+            },
+            "sendBulkNotification": False,
+        }
+        try:
+            response = self._api._session.post(
+                self._api._get_url("bulk/issues/fields", base=BULK_EDIT_URL),
+                data=json.dumps(payload),
+            )
+        except JIRAError as exc:
+            if exc.status_code not in (404, 405):
+                raise
+            print(
+                f"Bulk edit is not available ({exc.status_code}), updating one by one"
+            )
+            return False
+
+        # edit is asynchronous, it is done when its task is
+        task_id = response.json()["taskId"]
+        deadline = time.monotonic() + BULK_EDIT_TIMEOUT
+        while True:
+            task = self._api._get_json(f"bulk/queue/{task_id}", base=BULK_EDIT_URL)
+            if task["status"] not in ("ENQUEUED", "RUNNING"):
+                break
+            if time.monotonic() > deadline:
+                print("Bulk edit is not finished in time, updating one by one")
+                return False
+            time.sleep(BULK_EDIT_POLL_INTERVAL)
+
+        if task["status"] != "COMPLETE" or task.get("failedAccessibleIssues"):
+            print(
+                f"Bulk edit ended as {task['status']} with"
+                f" {len(task.get('failedAccessibleIssues') or {})} failed issues,"
+                " updating one by one"
+            )
+            return False
+        return True
+
+    def _add_issue_to_release_version(self, version: Version, key: str):
+        self._api._session.put(
+            self._api._get_url(f"issue/{key}"),
+            data=json.dumps(
+                {"update": {"fixVersions": [{"add": {"name": version.name}}]}}
+            ),
+        )
+
+    def _get_linked_keys(self, issue_key: str) -> Set[str]:
+        """Keys of issues already linked to the issue with configured link type"""
+        issue = self._get_issue(issue_key, fields="issuelinks")
+        link_type = self.release_task.link_type.lower()
+
+        return {
+            link.key
+            for link in issue.links
+            if link_type in {name.lower() for name in link.type_names}
+        }
+
+    def _get_link_type(self) -> Tuple[str, bool]:
+        """
+        Resolve configured link type (name or its inward/outward description)
+        to type name and whether issues have to be swapped
+        """
+        link_type = self.release_task.link_type.lower()
+        for issue_link_type in self._api.issue_link_types():
+            if link_type in {
+                issue_link_type.name.lower(),
+                issue_link_type.outward.lower(),
+            }:
+                return issue_link_type.name, False
+            if link_type == issue_link_type.inward.lower():
+                return issue_link_type.name, True
+
+        raise ValueError(f'Unknown Jira link type: "{self.release_task.link_type}"')
+
+    def make_links(
+        self,
+        version: Optional[Version],
+        release_task_key,
+        related_keys,
+        previously_linked_keys: Iterable[str] = (),
+    ) -> List[str]:
+        """
+        Link tasks to release task, returns keys which are linked.
+        Version is added to tasks linked by previous runs too, it may be chosen
+        only by this one
+        """
         version_name = version.name if version else "-"
         print_title(
             f"Linking tasks found in release branch"
             f" to release task ({release_task_key})"
             f' and to Jira version "{version_name}"'
         )
+
+        already_linked_keys = (
+            self._get_linked_keys(release_task_key) if related_keys else set()
+        )
+        keys_to_link = [key for key in related_keys if key not in already_linked_keys]
+        linked_keys = [key for key in related_keys if key in already_linked_keys]
+
+        print(f"Linking {len(keys_to_link)} tasks:")
+        if keys_to_link:
+            partial_make_links = partial(
+                self._make_links, release_task_key, *self._get_link_type()
+            )
+            with ThreadPool(self._governor.max_concurrency) as pool:
+                results = pool.map(partial_make_links, keys_to_link)
+            linked_keys += [key for key, ok in zip(keys_to_link, results) if ok]
+
+        failed_count = len(related_keys) - len(linked_keys)
+        print(
+            f"Links created: {len(keys_to_link) - failed_count},"
+            f" skipped (already exist): {len(related_keys) - len(keys_to_link)},"
+            f" failed: {failed_count}"
+        )
+
         if version:
-            self._add_to_release_version(version, release_task_key)
+            self._add_to_release_version(
+                version,
+                [release_task_key, *sorted(previously_linked_keys), *linked_keys],
+            )
 
-        print(f"Linking {len(related_keys)} tasks:")
-        partial_make_links = partial(self._make_links, version, release_task_key)
-        with ThreadPool(5) as pool:
-            pool.map(partial_make_links, related_keys)
+        return linked_keys
 
     def _make_links(
-        self, version: Optional[Version], release_task_key: str, child_task_key: str
-    ):
+        self, release_task_key: str, link_type: str, swap: bool, child_task_key: str
+    ) -> bool:
         print(f"* {child_task_key}")
-        self._api.create_issue_link(
-            self.release_task.link_type, release_task_key, child_task_key
-        )
-        if version:
-            self._add_to_release_version(version, child_task_key)
+        inward_key, outward_key = release_task_key, child_task_key
+        if swap:
+            inward_key, outward_key = outward_key, inward_key
+
+        try:
+            self._api._session.post(
+                self._api._get_url("issueLink"),
+                data=json.dumps(
+                    {
+                        "type": {"name": link_type},
+                        "inwardIssue": {"key": inward_key},
+                        "outwardIssue": {"key": outward_key},
+                    }
+                ),
+            )
+        except JIRAError as exc:
+            print_error(f"Failed to link {child_task_key}: {exc.text}")
+            return False
+        return True
 
     def make_release_task(self):
         print_title("Creating Jira release task")
@@ -179,7 +538,7 @@ class JiraAPI:
             f' AND summary ~ "{self.release_task_name}"'
             f' AND type = "{self.release_task.type}"'
         )
-        found_issues = self._api.search_issues(query)
+        found_issues = list(self._search(query, fields="status"))
 
         if not found_issues:
             print("Did not find existing release task")
@@ -202,16 +561,19 @@ class JiraAPI:
             f'Transition release task "{release_task_key}" from "{self.transition.release_from_status}" to "{self.transition.release_to_status}"'
         )
 
-        release_issue = self._api.issue(release_task_key)
-        print_title(f'Current release task status is "{release_issue.fields.status}"')
+        release_issue = self._get_issue(
+            release_task_key, fields="issuetype,status", expand="transitions"
+        )
+        print_title(f'Current release task status is "{release_issue.status}"')
 
-        if (
-            release_issue.fields.status.name.lower()
-            != self.transition.release_from_status.lower()
-        ):
-            print_error(f'Release task "{release_task_key}" has inproper status')
+        if release_issue.status.lower() == self.transition.release_to_status.lower():
+            print(f'Release task "{release_task_key}" is already transited')
             return
 
+        if release_issue.status.lower() != self.transition.release_from_status.lower():
+            print_error(f'Release task "{release_task_key}" has inproper status')
+            exit(1)
+
         transition = self._get_transition(
             release_issue, self.transition.release_to_status
         )
@@ -220,13 +582,48 @@ class JiraAPI:
             print_error(
                 f'Release task "{release_task_key}" has no transition to "{self.transition.release_to_status}"'
             )
-            return
+            exit(1)
 
-        self._api.transition_issue(release_issue, transition["id"])
+        # step is not done, so a rerun repeats it
+        if not self._transition_issue(release_issue.key, transition):
+            exit(1)
 
-        print(
-            f'Release task {release_issue.key} has been transited to status "{transition["name"]}"'
-        )
+    def _get_transition(
+        self, issue: IssueRecord, transition_name: str
+    ) -> Optional[dict]:
+        """
+        Transitions are expanded in search results, if they are not,
+        they are requested once per issue type and status
+        """
+        transitions = issue.transitions
+        if transitions is None:
+            cache_key = (issue.issuetype, issue.status)
+            if cache_key not in self._transitions_cache:
+                self._transitions_cache[cache_key] = self._api._get_json(
+                    f"issue/{issue.key}/transitions"
+                )["transitions"]
+            transitions = self._transitions_cache[cache_key]
+
+        transitions = [
+            t for t in transitions if t["name"].lower() == transition_name.lower()
+        ]
+        if not transitions:
+            return None
+
+        return transitions[0]
+
+    def _transition_issue(self, key: str, transition: dict) -> bool:
+        try:
+            self._api._session.post(
+                self._api._get_url(f"issue/{key}/transitions"),
+                data=json.dumps({"transition": {"id": transition["id"]}}),
+            )
+        except JIRAError as exc:
+            print_error(f"Failed to transit task {key}: {exc.text}")
+            return False
+
+        print(f'Task {key} has been transited to status "{transition["name"]}"')
+        return True
 
     def mark_children_tasks_done(self, release_task_key):
         print_title(
@@ -237,7 +634,9 @@ class JiraAPI:
             f'issue in linkedIssues("{release_task_key}")'
             f' AND status = "{self.transition.child_from_status}"'
         )
-        found_issues = self._api.search_issues(query)
+        found_issues = list(
+            self._search(query, fields="issuetype,status", expand="transitions")
+        )
 
         to_status = self.transition.child_to_status.lower()
 
@@ -245,19 +644,31 @@ class JiraAPI:
             print("Did not find any task for transition")
             return
 
+        planned_transitions = []
+        failed_keys = []
         for issue in found_issues:
             transition = self._get_transition(issue, to_status)
             if not transition:
                 print_error(
                     f'Issue "{issue.key}" does not have transition to status "{self.transition.child_to_status}"'
                 )
+                failed_keys.append(issue.key)
                 continue
 
-            self._api.transition_issue(issue, transition["id"])
-            print(
-                f'Task {issue.key} has been transited to status "{transition["name"]}"'
-            )
+            planned_transitions.append((issue.key, transition))
+
+        with ThreadPool(self._governor.max_concurrency) as pool:
+            transited = pool.starmap(self._transition_issue, planned_transitions)
+
+        failed_keys += [
+            key for (key, _), ok in zip(planned_transitions, transited) if not ok
+        ]
+        if failed_keys:
+            # step is not done, so a rerun repeats it
+            print_error(f"Tasks are not transited: {', '.join(failed_keys)}")
+            exit(1)
 
 
 def _get_formatted_date():
-    return datetime.today().strftime("%Y-%m-%d")
+    # recorded date when replaying, as requests are matched by their body
+    return CASSETTE.today().strftime("%Y-%m-%d")
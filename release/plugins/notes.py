@@ -0,0 +1,109 @@
+import json
+from typing import TYPE_CHECKING, Dict, Iterable, Optional, TextIO
+
+from .conf import NotesFormat
+
+
+if TYPE_CHECKING:
+    from .jira import IssueRecord
+
+
+__all__ = ["ReleaseNotesWriter"]
+
+
+class ReleaseNotesWriter:
+    """
+    Writes release notes as their parts are fetched, so they can be piped on:
+    Markdown, or JSON Lines with an object per release, task and pull request
+    """
+
+    def __init__(
+        self, output: TextIO, notes_format: str, jira_server: str, repository: str
+    ):
+        self._output = output
+        self._json = NotesFormat(notes_format) == NotesFormat.JSON
+        self._jira_server = jira_server.rstrip("/")
+        self._repository = repository
+
+    def _write(self, text: str):
+        self._output.write(text + "\n")
+        self._output.flush()
+
+    def _write_json(self, record: dict):
+        self._write(json.dumps(record, ensure_ascii=False))
+
+    def write_release(
+        self, version: str, branch: str, base: str, head: Optional[str] = None
+    ):
+        if self._json:
+            self._write_json(
+                {
+                    "type": "release",
+                    "version": version,
+                    "branch": branch,
+                    "base": base,
+                    "head": head,
+                }
+            )
+            return
+
+        self._write(f"# Release {version}\n")
+        self._write(
+            f"Commits of `{branch}`"
+            + (f" up to `{head[:10]}`" if head else "")
+            + f" not in `{base}`"
+        )
+
+    def write_tasks(self, issues: Iterable["IssueRecord"]):
+        for index, issue in enumerate(issues):
+            url = f"{self._jira_server}/browse/{issue.key}"
+            if self._json:
+                self._write_json(
+                    {
+                        "type": "task",
+                        "key": issue.key,
+                        "summary": issue.summary,
+                        "issuetype": issue.issuetype,
+                        "components": list(issue.components),
+                        "status": issue.status,
+                        "url": url,
+                    }
+                )
+                continue
+
+            if not index:
+                self._write("\n## Tasks\n")
+            if issue.summary is None:
+                self._write(f"- [{issue.key}]({url}) (not found in Jira)")
+                continue
+
+            details = ", ".join(
+                filter(None, (issue.issuetype, *issue.components, issue.status))
+            )
+            self._write(
+                f"- [{issue.key}]({url}) {_escape(issue.summary)}"
+                + (f" _({details})_" if details else "")
+            )
+
+    def write_pulls(self, titles: Dict[int, str]):
+        for index, (number, title) in enumerate(sorted(titles.items())):
+            url = f"https://github.com/{self._repository}/pull/{number}"
+            if self._json:
+                self._write_json(
+                    {
+                        "type": "pull_request",
+                        "number": number,
+                        "title": title,
+                        "url": url,
+                    }
+                )
+                continue
+
+            if not index:
+                self._write("\n## Pull requests without task\n")
+            self._write(f"- [#{number}]({url}) {_escape(title)}")
+
+
+def _escape(text: str) -> str:
+    """Summary as a single line of Markdown, its brackets don't make links"""
+    return " ".join(text.split()).replace("[", "\\[").replace("]", "\\]")
@@ -0,0 +1,105 @@
+import inspect
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+
+__all__ = ["PROFILER", "Profiler"]
+
+SUMMARY_SIZE = 15
+
+
+class Profiler:
+    """
+    Collects timed spans of a run (`--profile`) and saves them as Chrome trace
+    events, which can be opened in https://ui.perfetto.dev or chrome://tracing.
+    Does nothing until enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._events = []
+        self._threads = {}
+        self._started_at = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self._started_at = time.perf_counter()
+
+    def _thread_id(self) -> int:
+        ident = threading.get_ident()
+        with self._lock:
+            return self._threads.setdefault(ident, len(self._threads) + 1)
+
+    @contextmanager
+    def span(self, name: str, category: str):
+        if not self.enabled:
+            yield
+            return
+
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            finished_at = time.perf_counter()
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (started_at - self._started_at) * 1e6,
+                "dur": (finished_at - started_at) * 1e6,
+                "pid": os.getpid(),
+                "tid": self._thread_id(),
+            }
+            with self._lock:
+                self._events.append(event)
+
+    def instrument(self, category: str):
+        """Class decorator, makes a span of every call of public methods"""
+
+        def decorator(cls):
+            for name, method in list(vars(cls).items()):
+                if not name.startswith("_") and inspect.isfunction(method):
+                    setattr(
+                        cls,
+                        name,
+                        self._wrap(method, f"{cls.__name__}.{name}", category),
+                    )
+            return cls
+
+        return decorator
+
+    def _wrap(self, func, name: str, category: str):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.span(name, category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def save(self, path: str):
+        with open(path, "w") as fo:
+            json.dump({"traceEvents": self._events, "displayTimeUnit": "ms"}, fo)
+        print(f"Profile is saved to {path}, open it with https://ui.perfetto.dev")
+
+    def print_summary(self):
+        totals = defaultdict(lambda: [0, 0.0, 0.0])
+        for event in self._events:
+            total = totals[(event["cat"], event["name"])]
+            total[0] += 1
+            total[1] += event["dur"] / 1e6
+            total[2] = max(total[2], event["dur"] / 1e6)
+
+        print("\nSlowest spans:")
+        print(f"{'total, s':>9} {'max, s':>8} {'calls':>6}  {'category':<8} name")
+        slowest = sorted(totals.items(), key=lambda item: -item[1][1])
+        for (category, name), (count, total, longest) in slowest[:SUMMARY_SIZE]:
+            print(f"{total:9.2f} {longest:8.2f} {count:6}  {category:<8} {name}")
+
+
+PROFILER = Profiler()
@@ -0,0 +1,227 @@
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from .cache import ReleaseJournal
+from .profiling import PROFILER
+
+
+__all__ = ["Scheduler", "Step"]
+
+# steps are mostly waiting for git or network, their own requests are paced
+# by governors, so a few threads are enough to overlap them
+SCHEDULER_WORKERS = 4
+
+
+class Step(NamedTuple):
+    name: str
+    func: Callable[[], Any]
+    # names of steps to finish first, ones not added to scheduler are ignored
+    requires: Iterable[str] = ()
+    # asks user for input, so it is run in main thread with output shown at once
+    interactive: bool = False
+    # completion and result are saved to journal, so reruns skip the step
+    journaled: bool = False
+    # cheap check that step done by previous run is still in effect, gets its result
+    verify: Optional[Callable[[Any], bool]] = None
+
+
+class _StepLog:
+    """Output of a step, held back until output of preceding steps is written"""
+
+    def __init__(self, stream, lock: threading.RLock):
+        self._stream = stream
+        self._lock = lock
+        self._chunks: List[str] = []
+        self.live = False
+        self.finished = False
+
+    def write(self, text: str) -> int:
+        with self._lock:
+            if self.live:
+                self._stream.write(text)
+            else:
+                self._chunks.append(text)
+        return len(text)
+
+    def release(self):
+        """Write held output and pass the rest through, must be called under lock"""
+        if self._chunks:
+            self._stream.write("".join(self._chunks))
+            self._chunks.clear()
+            self._stream.flush()
+        self.live = True
+
+
+class _ThreadOutput:
+    """`sys.stdout` replacement sending output of a thread to log of its step"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    def set_log(self, log: Optional[_StepLog]):
+        self._local.log = log
+
+    def write(self, text: str) -> int:
+        log = getattr(self._local, "log", None)
+        if log is None:
+            return self.stream.write(text)
+        return log.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class Scheduler:
+    """
+    Runs steps as soon as steps they require are finished, independent ones
+    run concurrently. Output is written in order steps were added in: a step
+    running ahead of preceding ones is printed when they are finished.
+    After a step fails no more steps are started and its error is raised.
+    Journaled steps completed by a previous run are not run again.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = SCHEDULER_WORKERS,
+        journal: Optional[ReleaseJournal] = None,
+    ):
+        self._max_workers = max_workers
+        self._journal = journal
+        self._steps: Dict[str, Step] = {}
+        self.results: Dict[str, Any] = {}
+
+    def add(
+        self,
+        name: str,
+        func: Callable[[], Any],
+        requires: Iterable[str] = (),
+        interactive: bool = False,
+        journaled: bool = False,
+        verify: Optional[Callable[[Any], bool]] = None,
+    ):
+        assert name not in self._steps, f"Step {name} is already added"
+        self._steps[name] = Step(
+            name, func, tuple(requires), interactive, journaled, verify
+        )
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._steps
+
+    def _is_ready(self, step: Step) -> bool:
+        return all(
+            name in self.results or name not in self._steps for name in step.requires
+        )
+
+    def _execute(self, step: Step) -> Any:
+        with PROFILER.span(step.name, "phase"):
+            if not (step.journaled and self._journal):
+                return step.func()
+
+            entry = self._journal.get(step.name)
+            if entry is not None:
+                if step.verify is None or step.verify(entry.result):
+                    print(f"Skipped {step.name}: done by previous run")
+                    return entry.result
+                print(f"Repeating {step.name}: result of previous run is not found")
+                self._journal.discard(step.name)
+
+            result = step.func()
+            self._journal.save(step.name, result)
+            return result
+
+    def run(self) -> Dict[str, Any]:
+        output = _ThreadOutput(sys.stdout)
+        lock = threading.RLock()
+        logs = {name: _StepLog(output.stream, lock) for name in self._steps}
+        order = list(self._steps)
+        pending = dict(self._steps)
+        running = {}
+        failure: Optional[BaseException] = None
+
+        def run_step(step: Step):
+            output.set_log(logs[step.name])
+            try:
+                return self._execute(step)
+            finally:
+                output.set_log(None)
+
+        def collect(timeout: Optional[float] = None):
+            """Store results of finished worker steps, first error is raised later"""
+            nonlocal failure
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    self.results[name] = future.result()
+                except BaseException as exc:
+                    failure = failure or exc
+                logs[name].finished = True
+            advance()
+
+        def advance():
+            """Release output of steps in order up to the first unfinished one"""
+            with lock:
+                while order:
+                    log = logs[order[0]]
+                    log.release()
+                    if not log.finished:
+                        return
+                    order.pop(0)
+
+        sys.stdout = output
+        try:
+            with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                while pending or running:
+                    # a step failed meanwhile (e.g. during a prompt) stops the run
+                    if running:
+                        collect(timeout=0)
+                    ready = (
+                        [step for step in pending.values() if self._is_ready(step)]
+                        if failure is None
+                        else []
+                    )
+                    for step in ready:
+                        if not step.interactive:
+                            del pending[step.name]
+                            running[executor.submit(run_step, step)] = step.name
+
+                    interactive = [step for step in ready if step.interactive]
+                    if interactive:
+                        step = interactive[0]
+                        del pending[step.name]
+                        with lock:
+                            # hold output of other steps to not mix it with prompts
+                            for log in logs.values():
+                                log.live = False
+                            logs[step.name].release()
+                        try:
+                            self.results[step.name] = self._execute(step)
+                        except BaseException as exc:
+                            failure = exc
+                        logs[step.name].finished = True
+                        advance()
+                        continue
+
+                    if not running:
+                        if failure is None:
+                            raise ValueError(
+                                f"Steps have circular requirements: {', '.join(pending)}"
+                            )
+                        break
+
+                    collect()
+        finally:
+            sys.stdout = output.stream
+            with lock:
+                for name in order:
+                    logs[name].release()
+
+        if failure is not None:
+            raise failure
+        return self.results
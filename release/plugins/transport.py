@@ -0,0 +1,170 @@
+import threading
+import time
+from typing import Dict
+from urllib.parse import urlsplit
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+from .cassette import CASSETTE
+from .conf import HttpSettings
+from .governor import RequestGovernor
+from .http_stats import HTTP_STATS
+from .profiling import PROFILER
+
+
+__all__ = [
+    "GovernedAdapter",
+    "attach_to_github",
+    "attach_to_session",
+    "parse_timeouts",
+]
+
+# responses of Jira and GitHub APIs are JSON, which compresses well
+ACCEPT_ENCODING = "gzip, deflate"
+
+
+class GovernedAdapter(HTTPAdapter):
+    """
+    Sends requests through a governor: paced, throttling aware and retried.
+    Connection pool fits the governor concurrency, so connections are kept
+    alive and reused for the whole run instead of being opened again
+    """
+
+    def __init__(self, governor: RequestGovernor, settings: HttpSettings, **kwargs):
+        self.governor = governor
+        self._timeout = float(settings.timeout)
+        self._timeouts = parse_timeouts(settings.timeouts)
+        super().__init__(
+            pool_maxsize=governor.max_concurrency,
+            # governor limits requests in flight, so waiting for a free connection
+            # is short and better than opening one which is thrown away
+            pool_block=True,
+            **kwargs,
+        )
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        kwargs["timeout"] = self._timeouts.get(url.hostname, self._timeout)
+        started_at = time.perf_counter()
+        retries = []
+        response = None
+        try:
+            with PROFILER.span(f"{request.method} {url.netloc}{url.path}", "http"):
+                if CASSETTE.replaying:
+                    response = CASSETTE.replay_response(self.governor.name, request)
+                else:
+                    response = self._send(request, retries, **kwargs)
+                    CASSETTE.record_response(self.governor.name, request, response)
+            return response
+        finally:
+            HTTP_STATS.record(
+                service=self.governor.name,
+                method=request.method,
+                url=request.url,
+                status=response.status_code if response is not None else None,
+                bytes_out=len(request.body or b""),
+                bytes_in=len(response.content) if response is not None else 0,
+                retries=len(retries),
+                latency=time.perf_counter() - started_at,
+            )
+
+    def _send(self, request, retries: list, **kwargs):
+        """Send request, delays of retries made are added to `retries`"""
+        attempt = 0
+        waited = 0.0
+        while True:
+            try:
+                with self.governor.slot():
+                    response = super().send(request, **kwargs)
+            except (ConnectionError, Timeout):
+                retry = self.governor.retry_delay(request.method, None, attempt, waited)
+                if retry is None:
+                    raise
+            else:
+                retry = self.governor.retry_delay(
+                    request.method, response, attempt, waited
+                )
+                if retry is None:
+                    return response
+                response.close()
+
+            if retry.by_server:
+                waited += retry.delay
+            else:
+                attempt += 1
+            retries.append(retry.delay)
+            time.sleep(retry.delay)
+
+
+def parse_timeouts(value: str) -> Dict[str, float]:
+    """{host: seconds} of `host=seconds, ...`"""
+    timeouts = {}
+    for item in (value or "").split(","):
+        if item.strip():
+            host, _, seconds = item.partition("=")
+            timeouts[host.strip()] = float(seconds)
+    return timeouts
+
+
+def attach_to_session(
+    session: Session, governor: RequestGovernor, settings: HttpSettings
+):
+    """Route requests of a requests session (e.g. one of Jira client) via governor"""
+    adapter = GovernedAdapter(governor, settings)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+
+
+def attach_to_github(governor: RequestGovernor, settings: HttpSettings):
+    """
+    PyGithub creates a session per connection object, so its connection class
+    is replaced with one sending requests of all requesters via a single
+    governed session
+    """
+    # not imported at module level to not load PyGithub for Jira client
+    from github.Requester import (
+        HTTPRequestsConnectionClass,
+        HTTPSRequestsConnectionClass,
+        Requester,
+        RequestsResponse,
+    )
+
+    session = Session()
+    # like PyGithub does, to not fall back to credentials of .netrc
+    session.auth = Requester.noopAuth
+    attach_to_session(session, governor, settings)
+
+    class GovernedHTTPSConnection(HTTPSRequestsConnectionClass):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.session.close()
+            self.session = session
+            # requester shares its connection between threads,
+            # so a request is kept per thread until its response is read
+            self._requests = threading.local()
+
+        def request(self, verb, url, input, headers, *args, **kwargs):
+            self._requests.current = (verb, url, input, headers)
+
+        def getresponse(self):
+            verb, url, input, headers = self._requests.current
+            response = self.session.request(
+                verb,
+                f"{self.protocol}://{self.host}:{self.port}{url}",
+                headers=headers,
+                data=input,
+                verify=self.verify,
+                allow_redirects=False,
+            )
+            return RequestsResponse(response)
+
+        def close(self):
+            # session is kept alive for the whole run
+            pass
+
+    Requester.injectConnectionClasses(
+        HTTPRequestsConnectionClass, GovernedHTTPSConnection
+    )
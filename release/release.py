@@ -1,54 +1,119 @@
 #!/usr/bin/env python
+import os
+import sys
+import threading
+from contextlib import redirect_stdout
+
 from .plugins import git
+from .plugins.cache import ReleaseCursors, ReleaseJournal
 from .plugins.common import print_error
 from .plugins.conf import Settings
-from .plugins.github import GitHubAPI
-from .plugins.jira import JiraAPI
+from .plugins.notes import ReleaseNotesWriter
+from .plugins.scheduler import Scheduler
 
 
-def run(settings: Settings):
+class Clients:
+    """
+    Jira and GitHub clients are created on first use, so commands which don't need
+    them (e.g. pure git ones) don't import heavy libraries and make no requests
+    """
 
-    if settings.require_clean_repo:
-        git.check_repo_changes()
+    def __init__(self, settings: Settings):
+        self._settings = settings
+        # steps run concurrently, a client must be created only once
+        self._lock = threading.Lock()
+        self._github_api = None
+        self._jira_api = None
 
-    settings.parse_project_version()
-    github_api = GitHubAPI(settings)
-    jira_api = JiraAPI(settings)
+    @property
+    def github_api(self):
+        assert self._settings.require_github, "Commands don't require GitHub"
+        with self._lock:
+            if self._github_api is None:
+                from .plugins.github import GitHubAPI
 
-    if settings.require_jira_version and not settings.no_input:
-        jira_version = jira_api.get_version()
-    else:
-        jira_version = None
-    print(f"Jira version: {jira_version.name if jira_version else '-'}")
+                self._github_api = GitHubAPI(self._settings)
+        return self._github_api
 
-    git_flows = git.GitFlows(settings)
+    @property
+    def jira_api(self):
+        assert self._settings.require_jira, "Commands don't require Jira"
+        with self._lock:
+            if self._jira_api is None:
+                from .plugins.jira import JiraAPI
 
-    if settings.require_creation_of_release_branch:
-        assert settings.hooks.set_version
-        git_flows.make_release_branch(release_set=settings.hooks.set_version)
-        print("Made release branch")
+                self._jira_api = JiraAPI(self._settings)
+        return self._jira_api
 
-    if settings.require_creation_of_hotfix_branch:
+
+def run(settings: Settings):
+    """
+    Steps of commands are run by scheduler: each one waits only for steps it
+    needs, e.g. Jira version is selected and release task is searched
+    while release branch is made. Completed steps changing git or Jira are
+    journaled, so rerun of a failed release continues where it stopped
+    """
+    clients = Clients(settings)
+    journal = ReleaseJournal(
+        settings.cache,
+        # release name is known only after project version is
+        lambda: f"{_get_repository_id(settings)}:{settings.release_branch_name}",
+        restart=settings.restart,
+    )
+    scheduler = Scheduler(journal=journal)
+    results = scheduler.results
+    # release notes are the only output written to stdout, so they can be piped
+    notes_output = sys.stdout
+
+    def release_branch_exists(_) -> bool:
+        return bool(git.GIT.resolve(f"origin/{settings.release_branch_name}"))
+
+    def make_release_branch():
         assert settings.hooks.set_version
-        pulls = (github_api.repository.get_pull(pr) for pr in settings.prs)
-        list_of_commit_sha = (
-            pull.merge_commit_sha for pull in pulls if pull.merge_commit_sha
+        git.GitFlows(settings).make_release_branch(
+            release_set=settings.hooks.set_version
         )
+        print("Made release branch")
+
+    def get_hotfix_commits():
+        """Merge commits of hotfix PRs, all PRs are checked before branch is made"""
+        pulls = clients.github_api.get_pulls_info(settings.prs)
+        not_merged = [
+            str(pull.number)
+            for pull in pulls
+            if not pull.merged or not pull.merge_commit_sha
+        ]
+        if not_merged:
+            print_error(f"Pull requests are not merged: {', '.join(not_merged)}")
+            exit(1)
+        return [pull.merge_commit_sha for pull in pulls]
 
-        git_flows.make_hotfix_branch(
-            list_of_commit_sha=list_of_commit_sha,
+    def make_hotfix_branch():
+        assert settings.hooks.set_version
+        git.GitFlows(settings).make_hotfix_branch(
+            list_of_commit_sha=results["get hotfix commits"],
             release_set=settings.hooks.set_version,
         )
         print("Made hotfix branch")
 
-    if settings.require_creation_of_jira_task or settings.require_jira_task_search:
-        release_task_key = jira_api.get_release_task()
+    def select_jira_version():
+        jira_version = clients.jira_api.get_version(settings.jira_version_name)
+        print(f"Jira version: {jira_version.name if jira_version else '-'}")
+        return jira_version
 
-    if settings.require_jira_links:
+    def make_links():
         print("check jira links")
+        release_task_key = results["get release task"]
         assert release_task_key
 
-        relations = github_api.get_related_tasks()
+        cursors = ReleaseCursors(settings.cache)
+        cursor = None if settings.full_scan else cursors.get(release_task_key)
+
+        relations = clients.github_api.get_related_tasks(
+            since=cursor.sha if cursor else None
+        )
+        linked_keys = cursor.linked_keys if cursor else set()
+        new_keys = [key for key in relations.tasks if key not in linked_keys]
 
         if relations.pull_requests_without_task:
             print_error(
@@ -57,32 +122,210 @@ def run(settings: Settings):
                 )
             )
 
-        if not relations.tasks:
-            print_error("Did not find related tasks")
-        else:
-            jira_api.make_links(
-                version=jira_version,
+        version = results.get("select Jira version")
+        if not new_keys:
+            if linked_keys:
+                print("No new tasks to link")
+            else:
+                print_error("Did not find related tasks")
+        new_linked_keys = []
+        # version may be chosen only now, tasks linked before get it too
+        if new_keys or version:
+            new_linked_keys = clients.jira_api.make_links(
+                version=version,
                 release_task_key=release_task_key,
-                related_keys=relations.tasks,
+                related_keys=new_keys,
+                previously_linked_keys=linked_keys,
             )
 
+        if len(new_linked_keys) == len(new_keys):
+            cursors.save(release_task_key, relations.head, linked_keys | set(new_keys))
+        else:
+            print_error("Not all tasks were linked, rerun make-links to retry")
+
         print(
             "Made links from {} to {}".format(
-                release_task_key, ", ".join(relations.tasks)
+                release_task_key, ", ".join(new_linked_keys)
             )
         )
 
+    def mark_release_task_done():
+        assert results["get release task"]
+        clients.jira_api.mark_release_task_done(results["get release task"])
+
+    def mark_children_tasks_done():
+        assert results["get release task"]
+        clients.jira_api.mark_children_tasks_done(results["get release task"])
+        clients.jira_api.release_version(results["get release task"])
+
+    def make_release_notes():
+        relations = clients.github_api.get_related_tasks()
+        writer = ReleaseNotesWriter(
+            notes_output,
+            settings.notes_format,
+            jira_server=settings.jira.connection.server,
+            repository=clients.github_api.repository_name,
+        )
+        writer.write_release(
+            version=str(settings.version),
+            branch=settings.release_branch_name,
+            base=settings.git.master,
+            head=relations.head,
+        )
+        writer.write_tasks(clients.jira_api.get_issues(relations.tasks))
+        writer.write_pulls(
+            clients.github_api.get_prs_titles(relations.pull_requests_without_task)
+        )
+
+    if settings.require_clean_repo:
+        scheduler.add("check repo changes", git.check_repo_changes)
+
+    scheduler.add(
+        "get project version",
+        settings.parse_project_version,
+        # to not ask for version in a repo with changes
+        requires=["check repo changes"],
+        interactive=True,
+    )
+
+    if settings.require_jira_version and (
+        settings.jira_version_name or not settings.no_input
+    ):
+        scheduler.add(
+            "select Jira version",
+            select_jira_version,
+            requires=["get project version"],
+            interactive=not settings.jira_version_name,
+        )
+
+    if settings.require_creation_of_release_branch:
+        scheduler.add(
+            "make release branch",
+            make_release_branch,
+            requires=["check repo changes", "get project version"],
+            journaled=True,
+            verify=release_branch_exists,
+        )
+
+    if settings.require_creation_of_hotfix_branch:
+        scheduler.add("get hotfix commits", get_hotfix_commits)
+        scheduler.add(
+            "make hotfix branch",
+            make_hotfix_branch,
+            requires=[
+                "get hotfix commits",
+                "check repo changes",
+                "get project version",
+                "make release branch",
+            ],
+            journaled=True,
+            verify=release_branch_exists,
+        )
+
+    if settings.require_creation_of_jira_task or settings.require_jira_task_search:
+        scheduler.add(
+            "get release task",
+            lambda: clients.jira_api.get_release_task(),
+            requires=["get project version"],
+        )
+
+    if settings.require_jira_links:
+        scheduler.add(
+            "make links",
+            make_links,
+            requires=[
+                "get release task",
+                "select Jira version",
+                # links are made to tasks of commits pushed to release branch
+                "make release branch",
+                "make hotfix branch",
+            ],
+        )
+
     if settings.require_merge_to_master:
-        git_flows.merge_release_to_master()
+        scheduler.add(
+            "create release tag",
+            lambda: git.GitFlows(settings).create_tag(),
+            requires=[
+                "check repo changes",
+                "get project version",
+                # git steps change working tree, so they never overlap
+                "make release branch",
+                "make hotfix branch",
+                "make links",
+            ],
+            journaled=True,
+            verify=lambda _: bool(git.GIT.resolve(f"refs/tags/{settings.version}")),
+        )
+        scheduler.add(
+            "merge release to master",
+            lambda: git.GitFlows(settings).merge_release_to_master(with_tag=False),
+            requires=[
+                "check repo changes",
+                "get project version",
+                "make release branch",
+                "make hotfix branch",
+                "make links",
+                "create release tag",
+            ],
+            journaled=True,
+            verify=lambda _: git.GIT.is_ancestor(
+                f"refs/tags/{settings.version}", f"origin/{settings.git.master}"
+            ),
+        )
 
     if settings.require_merge_to_develop:
-        git_flows.merge_master_to_develop()
+        scheduler.add(
+            "merge master to develop",
+            lambda: git.GitFlows(settings).merge_master_to_develop(),
+            requires=[
+                "check repo changes",
+                "get project version",
+                "make release branch",
+                "make hotfix branch",
+                "merge release to master",
+            ],
+            journaled=True,
+            verify=lambda _: git.GIT.is_ancestor(
+                f"origin/{settings.git.master}", f"origin/{settings.git.base}"
+            ),
+        )
 
+    # tasks are done only when release is merged
+    merged = ["merge release to master", "merge master to develop"]
     if settings.require_mark_release_task_done:
-        assert release_task_key
-        jira_api.mark_release_task_done(release_task_key)
+        scheduler.add(
+            "mark release task done",
+            mark_release_task_done,
+            requires=["get release task", *merged],
+            journaled=True,
+        )
 
     if settings.require_mark_chldren_tasks_done:
-        assert release_task_key
-        jira_api.mark_children_tasks_done(release_task_key)
-        jira_api.release_version(release_task_key)
+        scheduler.add(
+            "mark children tasks done",
+            mark_children_tasks_done,
+            requires=["get release task", *merged],
+            journaled=True,
+        )
+
+    if settings.require_release_notes:
+        scheduler.add(
+            "make release notes",
+            make_release_notes,
+            # notes are of commits pushed to release branch
+            requires=[
+                "get project version",
+                "make release branch",
+                "make hotfix branch",
+            ],
+        )
+
+    with redirect_stdout(sys.stderr if settings.require_release_notes else sys.stdout):
+        scheduler.run()
+
+
+def _get_repository_id(settings: Settings) -> str:
+    return (
+        settings.github.repository or git.GIT.config("remote.origin.url") or os.getcwd()
+    )